@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import lxml.html
+import requests
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0"
+
+
+def make_session(pool_size: int = 8) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def fetch_article_page(session, url: str, timeout: float = 20):
+    """論文ページのHTMLを取得してlxmlでパースする。取得できなければNoneを返す"""
+    try:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Failed to fetch {url}: {e!r}")
+        return None
+    return lxml.html.fromstring(response.content, base_url=response.url)
+
+
+def fetch_article_pages(session, urls: list, max_workers: int = 8) -> list:
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="article") as executor:
+        return list(executor.map(lambda url: fetch_article_page(session, url), urls))
+
+
+def page_from_driver(driver, url: str):
+    """JavaScriptが必要なページ用。ブラウザで開いたページをlxmlでパースする"""
+    driver.get(url)
+    return lxml.html.fromstring(driver.page_source, base_url=url)
+
+
+def get_meta(tree, name: str) -> str:
+    values = tree.xpath(f'//meta[@name="{name}"]/@content')
+    return values[0] if values else None
+
+
+def get_abstract(tree) -> str:
+    divs = tree.xpath('//h2[text()="Abstract"]/following-sibling::div')
+    if not divs:
+        return None
+    paragraphs = divs[0].xpath(".//p") or [divs[0]]
+    text = " ".join(" ".join(p.text_content().split()) for p in paragraphs)
+    return text or None
+
+
+def get_publication_date(tree) -> str:
+    return get_meta(tree, "citation_online_date") or get_meta(tree, "citation_date")
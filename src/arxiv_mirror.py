@@ -0,0 +1,260 @@
+import datetime
+import json
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import arxiv
+from cache import text_hash
+
+
+@dataclass
+class ArxivPaper:
+    """arxiv.Resultのうち、通知とスライド作成に使う属性だけを持つ"""
+    entry_id: str
+    title: str
+    summary: str
+    authors: str
+    published: datetime.datetime
+    updated: datetime.datetime
+    primary_category: str = ""
+    categories: list = field(default_factory=list)
+    journal_ref: str = None
+    doi: str = None
+    pdf_url: str = None
+
+    def get_short_id(self) -> str:
+        return self.entry_id.split("arxiv.org/abs/")[-1]
+
+    @classmethod
+    def from_result(cls, result) -> "ArxivPaper":
+        return cls(
+            entry_id=result.entry_id,
+            title=result.title,
+            summary=result.summary,
+            authors=", ".join(author.name for author in result.authors),
+            published=result.published,
+            updated=result.updated,
+            primary_category=result.primary_category,
+            categories=list(result.categories),
+            journal_ref=result.journal_ref,
+            doi=result.doi,
+            pdf_url=result.pdf_url,
+        )
+
+    def to_dict(self) -> dict:
+        d = asdict(self)
+        d["published"] = self.published.isoformat()
+        d["updated"] = self.updated.isoformat()
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "ArxivPaper":
+        d = dict(d)
+        d["published"] = datetime.datetime.fromisoformat(d["published"])
+        d["updated"] = datetime.datetime.fromisoformat(d["updated"])
+        return cls(**d)
+
+
+def search_day(query: str, day, page_size: int = 100, max_results: float = float("inf")):
+    """
+    day(UTC)に投稿された論文を1件ずつ返すジェネレータ。
+    APIからはpage_size件ずつ取得するので、受け取った分から処理している間に次のページまでの待ち時間が過ぎる。
+    max_resultsにNoneを渡すとarxiv.Clientが比較に失敗するので、上限なしはfloat("inf")で表す。
+    """
+    key = day.strftime("%Y%m%d")
+    search = arxiv.Search(query=f"({query}) AND submittedDate:[{key}000000 TO {key}235959]",
+                          max_results=max_results,
+                          sort_by=arxiv.SortCriterion.SubmittedDate)
+    yield from arxiv.Client(page_size=page_size).results(search)
+
+
+class ArxivMirror:
+    """
+    arXivのメタデータをSQLiteに貯めておく。
+    投稿日ごとに1回だけAPIから取得し(harvest)、同じ論文はarXivのIDで1行にまとめる。
+    アブストラクトにはtrigramのFTS索引を張り、キーワードを含む論文だけを索引で取り出す(candidates)。
+    """
+
+    def __init__(self, path=":memory:"):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS papers "
+            "(id TEXT PRIMARY KEY, day TEXT, summary TEXT, data TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS papers_day ON papers (day)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS harvested "
+            "(day TEXT, query TEXT, n_papers INTEGER, harvested REAL, PRIMARY KEY (day, query))"
+        )
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(summary, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # trigramはSQLite 3.34以降。使えなければLIKEで探す
+            print(f"FTS is not available: {e}")
+            self.fts = False
+
+    @staticmethod
+    def day_key(day) -> str:
+        return day.strftime("%Y%m%d")
+
+    def add(self, paper: ArxivPaper) -> None:
+        # バージョンが変わっても同じ論文として1行にまとめる
+        id = re.sub(r"v\d+$", "", paper.get_short_id())
+        summary = paper.summary.replace("\n", " ")
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO papers (id, day, summary, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET day = excluded.day, summary = excluded.summary, data = excluded.data",
+                (id, self.day_key(paper.published), summary, json.dumps(paper.to_dict(), ensure_ascii=False)),
+            )
+            row = self.conn.execute("SELECT rowid FROM papers WHERE id = ?", (id,)).fetchone()
+            if self.fts:
+                self.conn.execute("DELETE FROM papers_fts WHERE rowid = ?", (row[0],))
+                self.conn.execute("INSERT INTO papers_fts (rowid, summary) VALUES (?, ?)", (row[0], summary))
+
+    def is_harvested(self, query: str, day) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT n_papers FROM harvested WHERE day = ? AND query = ?", (self.day_key(day), text_hash(query))
+            ).fetchone()
+        return row is not None
+
+    def harvest(self, query: str, day, force: bool = False, page_size: int = 100) -> int:
+        """
+        day(UTC)に投稿された論文をAPIから取得して貯める。取得済みの日は飛ばす。
+        結果はページごとに受け取りながら書き込むので、全件をリストにはしない。
+        途中で失敗した日と、1件も返ってこなかった日は取得済みにしないので、次回やり直す(重複はIDでまとまる)。
+        """
+        if not force and self.is_harvested(query, day):
+            print(f"arXiv papers of {day} are already in the mirror.")
+            return 0
+        key = self.day_key(day)
+        start = time.monotonic()
+        n_papers = 0
+        for result in search_day(query, day, page_size):
+            self.add(ArxivPaper.from_result(result))
+            n_papers += 1
+            if n_papers % 100 == 0:
+                self.conn.commit()
+        if n_papers == 0:
+            # APIは誤って空のページを返すことがあり、arxiv.Clientはそれを0件として再試行しない。
+            # 取得済みにすると次回以降もその日を飛ばしてしまうので、記録せずに次回やり直す
+            print(f"No arXiv papers of {day} were returned. The day will be harvested again next time.")
+            return 0
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO harvested (day, query, n_papers, harvested) VALUES (?, ?, ?, ?)",
+                (key, text_hash(query), n_papers, time.time()),
+            )
+        print(f"Harvested {n_papers} arXiv papers of {day} in {time.monotonic() - start:.1f} s.")
+        return n_papers
+
+    def candidates(self, keywords, day) -> list:
+        """
+        dayに投稿された論文のうち、アブストラクトにどれかのキーワードを含むものを返す。
+        索引は大文字と小文字を区別しないので、正確なスコアはcalc_scoreで計算し直すこと。
+        """
+        key = self.day_key(day)
+        ids = set()
+        with self.lock:
+            for word in keywords:
+                if self.fts and len(word) >= 3:
+                    rows = self.conn.execute(
+                        "SELECT p.id FROM papers_fts f JOIN papers p ON p.rowid = f.rowid "
+                        "WHERE papers_fts MATCH ? AND p.day = ?",
+                        ('"' + word.replace('"', '""') + '"', key),
+                    )
+                else:
+                    # trigramで探せない2文字以下のキーワード
+                    rows = self.conn.execute(
+                        "SELECT id FROM papers WHERE day = ? AND instr(lower(summary), lower(?)) > 0", (key, word))
+                ids.update(row[0] for row in rows)
+            n_papers = self.conn.execute("SELECT count(*) FROM papers WHERE day = ?", (key,)).fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT data FROM papers WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", sorted(ids)
+            ).fetchall()
+        print(f"{len(rows)} of {n_papers} arXiv papers of {day} contain keywords.")
+        return [ArxivPaper.from_dict(json.loads(row[0])) for row in rows]
+
+    def prune(self, days: int) -> None:
+        """days日より前に投稿された論文を消す"""
+        key = self.day_key(datetime.date.today() - datetime.timedelta(days=days))
+        with self.lock, self.conn:
+            if self.fts:
+                self.conn.execute("DELETE FROM papers_fts WHERE rowid IN (SELECT rowid FROM papers WHERE day < ?)", (key,))
+            self.conn.execute("DELETE FROM papers WHERE day < ?", (key,))
+            self.conn.execute("DELETE FROM harvested WHERE day < ?", (key,))
+
+    def export(self, path, day=None) -> None:
+        """JSON Linesに書き出す。load()で読み込めばAPIを使わずに動作確認できる"""
+        with self.lock:
+            if day is None:
+                rows = self.conn.execute("SELECT data FROM papers ORDER BY id").fetchall()
+            else:
+                rows = self.conn.execute("SELECT data FROM papers WHERE day = ? ORDER BY id", (self.day_key(day),)).fetchall()
+        with open(path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(row[0] + "\n")
+
+    def load(self, path) -> int:
+        n_papers = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.add(ArxivPaper.from_dict(json.loads(line)))
+                    n_papers += 1
+        self.conn.commit()
+        return n_papers
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+def main():
+    """
+    python arxiv_mirror.py record 20240105 dump.jsonl  # APIから取得して書き出す
+    python arxiv_mirror.py search dump.jsonl 20240105  # 書き出したものからconfig.yamlのキーワードで探す
+    """
+    import argparse
+    import os
+
+    import yaml
+    from keyword_matcher import KeywordMatcher
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["record", "search"])
+    parser.add_argument("args", nargs=2)
+    args = parser.parse_args()
+
+    config_path = f"{os.path.dirname(os.path.abspath(__file__))}/../config.yaml"
+    with open(config_path, "r", encoding="utf-8") as yml:
+        config = yaml.safe_load(yml)
+
+    mirror = ArxivMirror()
+    if args.command == "record":
+        day = datetime.datetime.strptime(args.args[0], "%Y%m%d").date()
+        mirror.harvest(config["subject"], day)
+        mirror.export(args.args[1], day)
+    else:
+        day = datetime.datetime.strptime(args.args[1], "%Y%m%d").date()
+        print(f"Loaded {mirror.load(args.args[0])} papers.")
+        matcher = KeywordMatcher(config["keywords"])
+        threshold = float(config["score_threshold"])
+        for paper in mirror.candidates(config["keywords"], day):
+            score, hits = matcher(paper.summary.replace("\n", " "))
+            if score >= threshold:
+                print(f"{score:5.1f} {paper.get_short_id()} {paper.title} {hits}")
+    mirror.close()
+
+
+if __name__ == "__main__":
+    main()
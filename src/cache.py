@@ -0,0 +1,76 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+def text_hash(*parts: str) -> str:
+    """空白の違いを無視してハッシュ化する"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(" ".join(str(part).split()).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class DiskCache:
+    """
+    SQLiteによる永続キャッシュ
+    ttl(秒)を過ぎたエントリと、max_entriesを超えた分の古いエントリは開く時に削除する。
+    """
+
+    def __init__(self, path, table: str = "cache", ttl: float = 30 * 24 * 3600, max_entries: int = 10000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+        )
+        self.evict()
+
+    def evict(self) -> None:
+        with self.lock, self.conn:
+            if self.ttl is not None:
+                self.conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,))
+            if self.max_entries is not None:
+                self.conn.execute(
+                    f"DELETE FROM {self.table} WHERE key NOT IN "
+                    f"(SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+
+    def get(self, key: str):
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and row[1] < time.time() - self.ttl):
+                self.misses += 1
+                return None
+            self.conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+
+    def stats(self) -> str:
+        return f"{self.table}: {self.hits} hits, {self.misses} misses"
+
+    def close(self) -> None:
+        self.evict()
+        self.conn.close()
@@ -19,6 +19,8 @@ from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.firefox.options import Options
 from webdriver_manager.firefox import GeckoDriverManager
 
+from keyword_matcher import KeywordMatcher
+
 # setting
 warnings.filterwarnings('ignore')
 
@@ -33,22 +35,15 @@ class Result:
     score: float = 0.0
 
 
-def calc_score(abst: str, keywords: dict) -> (float, list):
-    sum_score = 0.0
-    hit_kwd_list = []
-
-    for word in keywords.keys():
-        score = keywords[word]
-        if word.lower() in abst.lower():
-            sum_score += score
-            hit_kwd_list.append(word)
-    return sum_score, hit_kwd_list
+def calc_score(abst: str, matcher: KeywordMatcher) -> (float, list):
+    return matcher(abst)
 
 
 def search_keyword(
         articles: list, keywords: dict, score_threshold: float
         ) -> list:
     results = []
+    matcher = KeywordMatcher(keywords, case_sensitive_upper=False)
     
     # ヘッドレスモードでブラウザを起動
     options = Options()
@@ -77,7 +72,7 @@ def search_keyword(
         url = article['arxiv_url']
         title = article['title']
         abstract = article['summary']
-        score, hit_keywords = calc_score(abstract, keywords)
+        score, hit_keywords = calc_score(abstract, matcher)
         if (score != 0) and (score >= score_threshold):
             title_trans = get_translated_text('ja', 'en', title, driver)
             abstract = abstract.replace('\n', '')
@@ -0,0 +1,147 @@
+import hashlib
+import random
+import re
+import unicodedata
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize_doi(doi) -> str:
+    """"https://doi.org/10.1088/ABC" や "doi:10.1088/abc" を "10.1088/abc" にそろえる"""
+    if not doi:
+        return ""
+    doi = str(doi).strip().lower()
+    doi = re.sub(r"^(https?://(dx\.)?doi\.org/|doi:\s*)", "", doi)
+    return doi if doi.startswith("10.") else ""
+
+
+def normalize_title(title: str) -> str:
+    """大文字小文字、アクセント、HTMLタグ、TeXの記号、句読点の違いを無視したタイトル"""
+    title = unicodedata.normalize("NFKD", title or "")
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    title = re.sub(r"<[^>]+>", " ", title)
+    title = re.sub(r"\\[a-zA-Z]+|[^0-9a-zA-Z]+", " ", title.lower())
+    return " ".join(title.split())
+
+
+def shingles(text: str, k: int = 4) -> set:
+    """空白を除いた文字のk-gram"""
+    text = text.replace(" ", "")
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+_ROMAN = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100}
+_NOTICE_RE = re.compile(r"^(erratum|corrigendum|correction|retraction|reply|comment)\b")
+_PART_RE = re.compile(r"\b(part|vol|volume|paper|chapter|no)\s+([0-9]+|[ivxlc]+)\b")
+# 末尾の1文字 ("Wendelstein 7-X" のX、"Model C" など) は番号とみなさない
+_TRAILING_NUMERAL_RE = re.compile(r"\s([0-9]+|[ivxlc]{2,}|i)$")
+
+
+def _numeral(text: str) -> int:
+    if text.isdigit():
+        return int(text)
+    value = 0
+    for c, next_c in zip(text, text[1:] + " "):
+        value += -_ROMAN[c] if _ROMAN.get(next_c, 0) > _ROMAN[c] else _ROMAN[c]
+    return value
+
+
+def title_markers(title: str) -> tuple:
+    """
+    タイトルが似ていても別の論文であることを示す部分。
+    "Erratum:" などの前置きと、"Part I" / "Part 2" / 末尾の "II" などの番号(ローマ数字はアラビア数字にそろえる)
+    """
+    title = normalize_title(title)
+    m = _NOTICE_RE.match(title)
+    notice = m.group(1) if m else ""
+    parts = {(name if name != "vol" else "volume", _numeral(number)) for name, number in _PART_RE.findall(title)}
+    m = _TRAILING_NUMERAL_RE.search(_PART_RE.sub("", title))
+    if m:
+        parts.add(("", _numeral(m.group(1))))
+    return notice, frozenset(parts)
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class DedupIndex:
+    """
+    別々の情報源から来た同じ論文を見つけるための索引。
+    DOIが一致するか、正規化したタイトルのshingleのJaccard係数がthreshold以上なら同じ論文とみなす。
+    タイトルはMinHashをbands個に分けたLSHで候補を絞ってから、Jaccard係数を正確に計算する。
+    ただし次の場合はタイトルでは同じとみなさない。
+    - 同じ情報源どうし (情報源の中ではIDで区別されている)
+    - arXivのIDが両方あって違う
+    - "Erratum:" などの前置きや、"Part I" と "Part II" のような番号が違う
+    値には任意のオブジェクト(Resultなど)を持たせられる。
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, min_length: int = 20):
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.min_length = min_length
+        rng = random.Random(0)
+        self.permutations = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        self.by_doi = {}
+        self.buckets = {}
+        self.entries = []
+
+    def minhash(self, shingle_set: set) -> list:
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little")
+                  for s in shingle_set]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+
+    def band_keys(self, signature: list) -> list:
+        return [(i, tuple(signature[i * self.rows:(i + 1) * self.rows]))
+                for i in range(len(signature) // self.rows)]
+
+    def _title_shingles(self, title: str) -> set:
+        title = normalize_title(title)
+        # "Editorial" のような短いタイトルは別の論文でも一致するので使わない
+        return shingles(title) if len(title) >= self.min_length else set()
+
+    def find(self, doi=None, title: str = None, source: str = None, arxiv_id: str = None):
+        """同じ論文とみなせる登録済みの値を返す。なければNone"""
+        doi = normalize_doi(doi)
+        if doi and doi in self.by_doi:
+            return self.by_doi[doi]
+        shingle_set = self._title_shingles(title)
+        if not shingle_set:
+            return None
+        candidates = set()
+        for key in self.band_keys(self.minhash(shingle_set)):
+            candidates.update(self.buckets.get(key, ()))
+        markers = title_markers(title)
+        best, best_similarity = None, self.threshold
+        for i in sorted(candidates):
+            entry_doi, entry_shingles, value, entry_source, entry_arxiv_id, entry_markers = self.entries[i]
+            if doi and entry_doi and doi != entry_doi:
+                # DOIが両方あって違うなら、タイトルが似ていても別の論文(訂正記事など)
+                continue
+            if source is not None and source == entry_source:
+                continue
+            if arxiv_id and entry_arxiv_id and arxiv_id != entry_arxiv_id:
+                continue
+            if markers != entry_markers:
+                continue
+            similarity = jaccard(shingle_set, entry_shingles)
+            if similarity >= best_similarity:
+                best, best_similarity = value, similarity
+        return best
+
+    def add(self, value, doi=None, title: str = None, source: str = None, arxiv_id: str = None) -> None:
+        doi = normalize_doi(doi)
+        if doi:
+            self.by_doi.setdefault(doi, value)
+        shingle_set = self._title_shingles(title)
+        self.entries.append((doi, shingle_set, value, source, arxiv_id, title_markers(title)))
+        if shingle_set:
+            for key in self.band_keys(self.minhash(shingle_set)):
+                self.buckets.setdefault(key, []).append(len(self.entries) - 1)
@@ -0,0 +1,169 @@
+import asyncio
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import feedparser
+import httpx
+
+
+class HostLimiter:
+    """同じホストへの同時接続数と、リクエストの最小間隔を制限する"""
+
+    def __init__(self, per_host: int = 2, interval: float = 0.5):
+        self.per_host = per_host
+        self.interval = interval
+        self.semaphores = {}
+        self.last_request = {}
+
+    def host(self, url: str) -> "HostSlot":
+        return HostSlot(self, urllib.parse.urlsplit(url).netloc)
+
+
+class HostSlot:
+    def __init__(self, limiter: HostLimiter, host: str):
+        self.limiter = limiter
+        self.host = host
+
+    async def __aenter__(self):
+        semaphore = self.limiter.semaphores.setdefault(self.host, asyncio.Semaphore(self.limiter.per_host))
+        await semaphore.acquire()
+        wait = self.limiter.last_request.get(self.host, 0) + self.limiter.interval - time.monotonic()
+        self.limiter.last_request[self.host] = time.monotonic() + max(0, wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.limiter.semaphores[self.host].release()
+        return False
+
+
+def entry_id(entry) -> str:
+    return entry.get("id") or entry.get("link")
+
+
+class FeedState:
+    """
+    フィードごとのETag, Last-Modified, 最後に取得した本文と処理済みのエントリIDを保存する。
+    処理済みにするのは、対象日に処理したエントリと対象日より古いエントリだけ。
+    状態はcommit()するまで保存されないので、途中で失敗した場合は次回やり直しになる。
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.states = {}
+
+    def get(self, url: str) -> dict:
+        if url not in self.states:
+            self.states[url] = self.cache.get(url) or {}
+        return self.states[url]
+
+    def headers(self, url: str) -> dict:
+        state = self.get(url)
+        headers = {}
+        if "body" not in state:
+            return headers
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        return headers
+
+    def update(self, url: str, response) -> None:
+        state = self.get(url)
+        state["etag"] = response.headers.get("etag")
+        state["last_modified"] = response.headers.get("last-modified")
+        state["body"] = response.text
+
+    def is_seen(self, url: str, entry) -> bool:
+        return entry_id(entry) in self.get(url).get("seen", [])
+
+    def mark_seen(self, url: str, entry) -> None:
+        seen = self.get(url).setdefault("seen", [])
+        if (i := entry_id(entry)) not in seen:
+            seen.append(i)
+
+    def all_seen(self, url: str) -> bool:
+        state = self.get(url)
+        return "entry_ids" in state and set(state["entry_ids"]) <= set(state.get("seen", []))
+
+    def drop_seen(self, url: str, d) -> None:
+        state = self.get(url)
+        state["entry_ids"] = [entry_id(entry) for entry in d["entries"]]
+        n_entries = len(d["entries"])
+        d["entries"] = [entry for entry in d["entries"] if not self.is_seen(url, entry)]
+        if n_entries != len(d["entries"]):
+            print(f"{n_entries - len(d['entries'])} entries in {url} were already processed.")
+
+    def commit(self) -> None:
+        for url, state in self.states.items():
+            # フィードから消えたエントリは二度と出てこないので忘れる
+            entry_ids = set(state.get("entry_ids", []))
+            state["seen"] = [i for i in state.get("seen", []) if i in entry_ids]
+            self.cache.set(url, state)
+
+
+async def fetch_feed(client, url: str, semaphore, limiter: HostLimiter, headers: dict = None):
+    async with semaphore, limiter.host(url):
+        start = time.monotonic()
+        try:
+            response = await client.get(url, headers=headers)
+            if response.status_code == 304:
+                print(f"{url} is not modified.")
+                return response
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"Failed to fetch {url}: {e!r}")
+            return None
+        print(f"Fetched {url} in {time.monotonic() - start:.1f} s.")
+        return response
+
+
+async def fetch_and_parse_feeds_async(urls: list, max_concurrency: int = 8, per_host: int = 2,
+                                      interval: float = 0.5, timeout: float = 20, state: FeedState = None) -> dict:
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = HostLimiter(per_host, interval)
+    loop = asyncio.get_running_loop()
+    feeds = {}
+    async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
+        with ThreadPoolExecutor(thread_name_prefix="feedparser") as executor:
+            async def fetch_and_parse(url):
+                headers = state.headers(url) if state is not None else None
+                response = await fetch_feed(client, url, semaphore, limiter, headers)
+                if response is None:
+                    return None
+                if response.status_code == 304:
+                    # 前回の本文のエントリを全て処理済みならパースもしない
+                    if state.all_seen(url):
+                        return None
+                    body = state.get(url)["body"]
+                else:
+                    body = response.content
+                    if state is not None:
+                        state.update(url, response)
+                headers = {"content-location": str(response.url),
+                           "content-type": response.headers.get("content-type", "")}
+                # feedparserはCPUを使うので、イベントループを止めないようにスレッドで実行する
+                d = await loop.run_in_executor(
+                    executor, lambda: feedparser.parse(body, response_headers=headers))
+                if state is not None:
+                    state.drop_seen(url, d)
+                return d
+
+            parsed = await asyncio.gather(*[fetch_and_parse(url) for url in urls])
+    for url, d in zip(urls, parsed):
+        feeds[url] = d
+    return feeds
+
+
+def fetch_and_parse_feeds(urls: list, **kwargs) -> dict:
+    """
+    RSSフィードを並列に取得してfeedparserでパースする。
+    取得に失敗したフィードの値はNoneになる。
+    """
+    start = time.monotonic()
+    feeds = asyncio.run(fetch_and_parse_feeds_async(list(dict.fromkeys(urls)), **kwargs))
+    n_ok = sum(d is not None for d in feeds.values())
+    print(f"Fetched {n_ok}/{len(feeds)} feeds in {time.monotonic() - start:.1f} s.")
+    return feeds
@@ -0,0 +1,78 @@
+class KeywordMatcher:
+    """
+    config.yamlのキーワードから一度だけ構築し、アブストごとのlower()を1回で済ませるマッチャー。
+    case_sensitive_upper=True の場合、全て大文字のキーワード(VMECなど)は大文字小文字を区別する。
+    """
+
+    def __init__(self, keywords: dict, case_sensitive_upper: bool = True):
+        self.keywords = dict(keywords)
+        self.case_sensitive = []
+        self.case_insensitive = []
+        for word in self.keywords:
+            if case_sensitive_upper and word.isupper():
+                self.case_sensitive.append(word)
+            else:
+                self.case_insensitive.append((word, word.lower()))
+
+    def __call__(self, abst: str):
+        abst_lower = abst.lower()
+        hits = {word for word in self.case_sensitive if word in abst}
+        hits.update(word for word, lower in self.case_insensitive if lower in abst_lower)
+
+        sum_score = 0.0
+        hit_kwd_list = []
+        for word, score in self.keywords.items():
+            if word in hits:
+                sum_score += score
+                hit_kwd_list.append(word)
+        return sum_score, hit_kwd_list
+
+
+def benchmark(n_abst: int = 10000, n_words: int = 200, seed: int = 0):
+    """
+    従来のキーワードごとのループとslide_owl.calc_scoreを比較するベンチマーク
+    python src/keyword_matcher.py で実行できる。
+    """
+    import os
+    import random
+    import time
+
+    import yaml
+    from slide_owl import calc_score
+
+    config_path = f"{os.path.dirname(os.path.abspath(__file__))}/../config.yaml"
+    with open(config_path, "r", encoding="utf-8") as yml:
+        keywords = yaml.safe_load(yml)["keywords"]
+
+    random.seed(seed)
+    vocab = [w for word in keywords for w in word.split()]
+    vocab += ["we", "propose", "a", "novel", "method", "for", "the", "of", "and", "results", "show", "that"]
+    vocab += [f"term{i}" for i in range(500)]
+    absts = [" ".join(random.choice(vocab) for _ in range(n_words)) for _ in range(n_abst)]
+
+    def loop(abst):
+        sum_score = 0.0
+        hit_kwd_list = []
+        for word in keywords.keys():
+            if (word in abst) or (not word.isupper() and word.lower() in abst.lower()):
+                sum_score += keywords[word]
+                hit_kwd_list.append(word)
+        return sum_score, hit_kwd_list
+
+    start = time.perf_counter()
+    expected = [loop(abst) for abst in absts]
+    t_loop = time.perf_counter() - start
+    # 呼び出し側と同じく、マッチャーの構築も含めて測る
+    start = time.perf_counter()
+    matcher = KeywordMatcher(keywords)
+    actual = [calc_score(abst, matcher) for abst in absts]
+    t_calc_score = time.perf_counter() - start
+
+    assert expected == actual
+    print(f"{n_abst} abstracts, {len(keywords)} keywords")
+    print(f"loop:       {t_loop:.3f} s")
+    print(f"calc_score: {t_calc_score:.3f} s ({t_loop / t_calc_score:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark()
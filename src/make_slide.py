@@ -1,6 +1,21 @@
+import hashlib
+import os
+import re
+import socket
+import subprocess
+import time
+import urllib.parse
+from pathlib import Path
+from subprocess import run
+
 import fitz
 import pandas as pd
-from subprocess import run
+import requests
+from cache import DiskCache
+
+# 表のキャプション ("Table 1", "TABLE II")。"unstable" や "suitable" には一致しない
+TABLE_CAPTION_RE = re.compile(r"\b(?:Table|TABLE)\s+[0-9IVX]+")
+
 
 def period_newline(text):
     if "。" in text:
@@ -15,7 +30,8 @@ def recoverpix(doc, item):
 
     # special case: /SMask or /Mask exists
     if smask > 0:
-        pix0 = fitz.Pixmap(doc.extract_image(xref)["image"])
+        base = doc.extract_image(xref)["image"]
+        pix0 = fitz.Pixmap(base)
         if pix0.alpha:  # catch irregular situation
             pix0 = fitz.Pixmap(pix0, 0)  # remove alpha channel
         mask = fitz.Pixmap(doc.extract_image(smask)["image"])
@@ -24,7 +40,7 @@ def recoverpix(doc, item):
             pix = fitz.Pixmap(pix0, mask)
         except Exception as e:  # fallback to original base image in case of problems
             print(e)
-            pix = fitz.Pixmap(doc.extract_image(xref)["image"])
+            pix = fitz.Pixmap(base)
 
         if pix0.n > 3:
             ext = "pam"
@@ -50,69 +66,251 @@ def recoverpix(doc, item):
     return doc.extract_image(xref)
 
 
-def extract_images_from_pdf(fname, imgdir, min_width=200, min_height=200, relsize=0.05, abssize=2048, max_ratio=8, max_num=50):
+class PdfDocument:
     """
-    dimlimit = 0  # 100  # each image side must be greater than this
-    relsize = 0  # 0.05  # image : image size ratio must be larger than this (5%)
-    abssize = 0  # 2048  # absolute image size limit 2 KB: ignore if smaller
+    PDFを1回だけ開き、ページを1回だけ走査して画像・表・本文を取り出す。
+    必要なものが揃ったら残りのページは読まない。
     """
-    imgdir.mkdir(parents=True, exist_ok=True)
 
-    doc = fitz.open(fname)
-    page_count = doc.page_count  # number of pages
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            self.data = f.read()
+        self.doc = fitz.open(stream=self.data, filetype="pdf")
+        self.texts = []
+        self.images = []
+        self.tables = []
+        self.xreflist = []
+        self.imgset = set()
 
-    xreflist = []
-    imglist = []
-    images = []
-    for pno in range(page_count):
-        if len(images) >= max_num:
-            break
-        il = doc.get_page_images(pno)
-        imglist.extend([x[0] for x in il])
+    @property
+    def hash(self) -> str:
+        return hashlib.sha256(self.data).hexdigest()
+
+    def analyze(self, imgdir=None, tables=False, table_cache=None, table_time_budget=10, max_tables=50,
+                max_images=50, min_width=200, min_height=200, abssize=2048, max_ratio=8, texts=False):
+        """
+        imgdirがあれば画像をそこに書き出し、tablesがTrueなら表も探す。textsがTrueなら各ページの本文をself.textsに残す。
+        表は"Table 1"のようなキャプションがあるページだけを調べ、table_time_budget秒を超えたら打ち切る。
+        table_cacheがあればPDFのハッシュごとに表を保存し、同じPDFは解析し直さない。
+        途中で打ち切った時は一部の表しかないので保存せず、次回も解析し直す。
+        """
+        if imgdir is not None:
+            imgdir.mkdir(parents=True, exist_ok=True)
+        if tables and table_cache is not None and (cached := table_cache.get(self.hash)) is not None:
+            self.tables = cached
+            tables = False
+            table_cache = None
+        checked = set()  # 採用したものも弾いたものも、同じxrefは二度調べない
+        table_seconds = 0.0
+        n_table_pages = 0
+        for page in self.doc:
+            need_images = imgdir is not None and len(self.images) < max_images
+            need_tables = tables and len(self.tables) < max_tables
+            if not (need_images or need_tables or texts):
+                break
+            # 本文の抽出は画像の一覧より重いので、キャプションを探す時と呼び出し側が使う時だけ行う
+            text = page.get_text() if need_tables or texts else None
+            if texts:
+                self.texts.append(text)
+            if need_images:
+                self._extract_images(page, imgdir, checked, max_images, min_width, min_height, abssize, max_ratio)
+            if need_tables and TABLE_CAPTION_RE.search(text):
+                if table_seconds > table_time_budget:
+                    print(f"Table extraction stopped at page {page.number + 1}/{self.doc.page_count} after {table_time_budget} s.")
+                    tables = False
+                    table_cache = None
+                    continue
+                start = time.monotonic()
+                n_table_pages += 1
+                try:
+                    self._extract_tables(page, max_tables)
+                except Exception as e:
+                    print(e)
+                table_seconds += time.monotonic() - start
+        if n_table_pages:
+            print(f"Found {len(self.tables)} tables on {n_table_pages} pages in {table_seconds:.1f} s.")
+        if table_cache is not None:
+            table_cache.set(self.hash, self.tables)
+        return self
+
+    def _extract_images(self, page, imgdir, checked, max_num, min_width, min_height, abssize, max_ratio):
+        doc = self.doc
+        pno = page.number
+        il = page.get_images()
+        self.imgset.update(x[0] for x in il)
         for img in il:
             xref = img[0]
-            if xref in xreflist:
+            if xref in checked:
                 continue
+            checked.add(xref)
+            # ピクセルを展開する前に、画像の辞書と圧縮されたままの大きさで弾けるものを弾く
             width = img[2]
             height = img[3]
             if width < min_width and height < min_height:
                 continue
+            if min(width, height) <= 0 or width/height > max_ratio or height/width > max_ratio:
+                continue
+            if len(doc.xref_stream_raw(xref) or b"") <= abssize:
+                continue
             image = recoverpix(doc, img)
             imgdata = image["image"]
 
             if len(imgdata) <= abssize:
                 continue
-            if width/height > max_ratio or height/width > max_ratio:
-                continue
 
             imgname = f'img{pno+1:02}_{xref:05}.{image["ext"]}'
-            images.append((imgname, pno+1, width, height))
+            self.images.append((imgname, pno+1, width, height))
             with open(imgdir/imgname, "wb") as fout:
                 fout.write(imgdata)
-            xreflist.append(xref)
+            self.xreflist.append(xref)
+            if len(self.images) >= max_num:
+                break
+
+    def _extract_tables(self, page, max_num):
+        for table in page.find_tables().tables:
+            tab = table.extract()
+            if len(tab) < 2:
+                continue
+            columns = tab[0]
+            data_rows = tab[1:]
+            # HTMLの表の中に置くので、markdownではなくHTMLにする
+            self.tables.append(pd.DataFrame(data_rows, columns=columns).to_html(index=False, na_rep=""))
+            if len(self.tables) >= max_num:
+                break
+
+    def close(self) -> None:
+        self.doc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def extract_images_from_pdf(fname, imgdir, min_width=200, min_height=200, relsize=0.05, abssize=2048, max_ratio=8, max_num=50):
+    """
+    dimlimit = 0  # 100  # each image side must be greater than this
+    relsize = 0  # 0.05  # image : image size ratio must be larger than this (5%)
+    abssize = 0  # 2048  # absolute image size limit 2 KB: ignore if smaller
+    """
+    with PdfDocument(fname) as pdf:
+        pdf.analyze(imgdir, max_images=max_num, min_width=min_width, min_height=min_height,
+                    abssize=abssize, max_ratio=max_ratio)
+        return pdf.xreflist, list(pdf.imgset), pdf.images
+
 
-    imglist = list(set(imglist))
-    return xreflist, imglist, images
+# スライドで画像1枚を表示する枠の大きさ (2x2の表の1マス)
+CELL_WIDTH = 1600 * 0.33
+CELL_HEIGHT = 900 * 0.33
 
 
-def extract_tables_from_pdf(fname, max_num=50):
-    doc = fitz.open(fname)
-    page_count = doc.page_count  # number of pages
+def display_ratio(width, height):
+    return min(CELL_WIDTH / width, CELL_HEIGHT / height)
 
-    table_list = []
-    for pno in range(page_count):
-        tabs = doc[pno].find_tables()
-        if tabs.tables:
-            for table in tabs:
-                tab = table.extract()
-                columns = tab[0]
-                data_rows = tab[1:]
-                # table_list.append(pd.DataFrame(data_rows, columns=columns).to_html())
-                table_list.append(pd.DataFrame(data_rows, columns=columns).to_markdown(tablefmt="grid"))
-    return table_list
 
+def image_hash(pix) -> int:
+    """dHash。9x8の白黒に縮めて、隣り合う画素の明るさの大小を64ビットにする"""
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.colorspace is None or pix.colorspace.n != 1:
+        pix = fitz.Pixmap(fitz.csGRAY, pix)
+    small = fitz.Pixmap(pix, 9, 8, None)
+    samples = small.samples
+    stride = small.stride
+    bits = 0
+    for y in range(8):
+        for x in range(8):
+            bits = (bits << 1) | (samples[y * stride + x] > samples[y * stride + x + 1])
+    return bits
 
-def make_md(f, dir_path, summary_dict):
+
+def postprocess_images(imgdir, image_list, max_distance=6):
+    """
+    extract_images_from_pdfで書き出した画像を、スライドに表示される大きさまで縮小し、
+    dHashのハミング距離がmax_distance以下の画像(同じ図の使い回し)は最初の1枚だけ残す。
+    縮小しても小さくならない画像は元のまま残す。
+    """
+    hashes = []
+    images = []
+    n_before = 0
+    n_after = 0
+    for imgname, pno, width, height in image_list:
+        path = imgdir/imgname
+        data = path.read_bytes()
+        n_before += len(data)
+        try:
+            pix = fitz.Pixmap(data)
+        except Exception as e:
+            print(e)
+            images.append((imgname, pno, width, height))
+            n_after += len(data)
+            continue
+
+        h = image_hash(pix)
+        if any(bin(h ^ other).count("1") <= max_distance for other in hashes):
+            path.unlink()
+            continue
+        hashes.append(h)
+
+        ratio = display_ratio(pix.width, pix.height)
+        if ratio < 1:
+            new_width = max(1, int(pix.width * ratio))
+            new_height = max(1, int(pix.height * ratio))
+            if pix.colorspace is not None and pix.colorspace.n > 3:
+                pix = fitz.Pixmap(fitz.csRGB, pix)
+            small = fitz.Pixmap(pix, new_width, new_height, None)
+            if path.suffix in (".jpg", ".jpeg") and not small.alpha:
+                new_data = small.tobytes("jpg", jpg_quality=85)
+                new_name = imgname
+            else:
+                new_data = small.tobytes("png")
+                new_name = f"{path.stem}.png"
+            if len(new_data) < len(data):
+                path.unlink()
+                (imgdir/new_name).write_bytes(new_data)
+                imgname, width, height, data = new_name, new_width, new_height, new_data
+        images.append((imgname, pno, width, height))
+        n_after += len(data)
+
+    print(f"Images: {len(image_list)} -> {len(images)}, {n_before/1e6:.2f} MB -> {n_after/1e6:.2f} MB "
+          f"({(n_before - n_after)/1e6:.2f} MB saved)")
+    return images
+
+
+def extract_tables_from_pdf(fname, max_num=50, time_budget=10, cache=None):
+    with PdfDocument(fname) as pdf:
+        pdf.analyze(tables=True, table_cache=cache, table_time_budget=time_budget, max_tables=max_num)
+        return pdf.tables
+
+
+def write_grid(f, cells, slide_class):
+    """2x2の表に1マスずつ並べる。1枚のスライドに4つまで"""
+    cells = list(cells)
+    while len(cells) % 4 != 0:
+        cells.append(None)
+    count=0
+    for cell in cells:
+        if count % 4 == 0:
+            f.write("\n---\n\n")
+            if count == 0:
+                f.write(f'<!-- class: {slide_class} -->\n')
+            f.write("<table>\n")
+        if count % 2 == 0:
+            f.write("\t<tr>\n")
+        f.write("\t\t<td>\n")
+        if cell is not None:
+            f.write(cell)
+        f.write("\t\t</td>\n")
+        if count % 2 == 1:
+            f.write("\t</tr>\n")
+        if count % 4 == 3:
+            f.write("</table>\n")
+        count += 1
+
+
+def make_md(f, dir_path, summary_dict, tables=False, table_options=None):
     f.write("\n---\n\n")
     if "title_jp" in summary_dict:
         f.write(f'# {summary_dict["title_jp"]}\n')
@@ -138,66 +336,115 @@ def make_md(f, dir_path, summary_dict):
     if summary_dict["pdf"] is None:
         return
     
-    pdf = summary_dict["pdf"]
-    _, _, image_list = extract_images_from_pdf(pdf, dir_path)
-    images = [{"src":imgname, "pno":str(pno), "width":str(width), "height":str(height)} for imgname, pno, width, height in image_list]
-    while len(images) % 4 != 0:
-        images.append(None)
-    count=0
-    for img in images:
-        if count % 4 == 0:
-            f.write("\n---\n\n")
-            if count == 0:
-                f.write('<!-- class: images -->\n')
-            f.write("<table>\n")
-        if count % 2 == 0:
-            f.write("\t<tr>\n")
-        f.write("\t\t<td>\n")
-        if img is not None:
-            width = int(img["width"])
-            height = int(img["height"])
-            x_ratio = (1600 * 0.33) / width
-            y_ratio = (900 * 0.33) / height
-            ratio = min(x_ratio, y_ratio)
-            f.write(f'\t\t\t<p><img src="{str(img["src"])}" width="{int(ratio * width)}"></p>\n')
-        f.write("\t\t</td>\n")
-        if count % 2 == 1:
-            f.write("\t</tr>\n")
-        if count % 4 == 3:
-            f.write("</table>\n")
-        count += 1
+    # 画像と表は1回開いたPDFから一緒に取り出す
+    with PdfDocument(summary_dict["pdf"]) as pdf:
+        pdf.analyze(dir_path, tables=tables, **(table_options or {}))
+    image_list = postprocess_images(dir_path, pdf.images)
+    write_grid(f, [f'\t\t\t<p><img src="{imgname}" width="{int(display_ratio(width, height) * width)}"></p>\n'
+                   for imgname, pno, width, height in image_list], "images")
 
-    # try:
-    #     tables = extract_tables_from_pdf(pdf)
-    #     count=0
-    #     for table in tables:
-    #         if count % 4 == 0:
-    #             f.write("\n---\n\n")
-    #             f.write("<table>\n")
-    #         if count % 2 == 0:
-    #             f.write("\t<tr>\n")
-    #         f.write("\t\t<td>\n")
-    #         if table is not None:
-    #             f.write(table)
-    #         f.write("\t\t</td>\n")
-    #         if count % 2 == 1:
-    #             f.write("\t</tr>\n")
-    #         if count % 4 == 3:
-    #             f.write("</table>\n")
-    #         count += 1
-    # except Exception as e:
-    #     print(e)
+    if tables:
+        write_grid(f, pdf.tables, "tables")
 
         
-def convert_md_to_pdf(md_file):
+def marp_command() -> list:
+    # npm ciでインストール済みならnpxでのパッケージ解決を省く
+    local = Path("node_modules/.bin/marp")
+    if local.exists():
+        return [str(local)]
+    return ["npx", "-p", "@marp-team/marp-cli", "marp"]
+
+
+class MarpServer:
+    """
+    marp-cliをサーバーモードで1回だけ起動し、markdownをPDFに変換させる。
+    変換のたびにNodeとChromiumを起動し直さずに済む。
+    rootより下にあるmarkdownだけを変換でき、GET /相対パス?pdf でPDFが返ってくる。
+    """
+
+    def __init__(self, root, theme: str = "marp.css", startup_timeout: float = 60, timeout: float = 120):
+        self.root = Path(root).resolve()
+        self.theme = theme
+        self.startup_timeout = startup_timeout
+        self.timeout = timeout
+        self.process = None
+        self.port = None
+        self.session = requests.Session()
+
+    def start(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        cmd = marp_command() + ["--server", "--html", "--theme", self.theme, "--allow-local-files", str(self.root)]
+        self.process = subprocess.Popen(cmd, env={**os.environ, "PORT": str(self.port)},
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        start = time.monotonic()
+        while time.monotonic() - start < self.startup_timeout:
+            if self.process.poll() is not None:
+                code, self.process = self.process.returncode, None
+                raise RuntimeError(f"marp server exited with code {code}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                print(f"Started marp server on port {self.port} in {time.monotonic() - start:.1f} s.")
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError("marp server did not start")
+
+    def convert(self, md_file, output) -> None:
+        path = Path(md_file).resolve().relative_to(self.root)
+        url = f"http://127.0.0.1:{self.port}/{urllib.parse.quote(path.as_posix())}?pdf"
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            with open(output, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+
+    def close(self) -> None:
+        self.session.close()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def convert_md_to_pdf(md_file, server: MarpServer = None):
     output = md_file.parent / f"{md_file.stem}_slide.pdf"
-    cmd = f"npx -p @marp-team/marp-cli marp --pdf --html --theme marp.css --allow-local-files {str(md_file)} -o {str(output)}"
-    run(cmd, shell=True)
+    if server is not None and server.process is not None:
+        try:
+            server.convert(md_file, output)
+            return output
+        except (requests.RequestException, ValueError) as e:
+            # サーバーで変換できなければ1回ずつmarpを起動する
+            print(f"marp server failed to convert {md_file}: {e!r}")
+    cmd = marp_command() + ["--pdf", "--html", "--theme", "marp.css", "--allow-local-files", str(md_file), "-o", str(output)]
+    run(cmd)
     return output
 
 
-def make_slides(dir_path, id, summary_dict):
+def write_markdown(dir_path, id, summary_dict, tables=False, table_cache_path=None, table_time_budget=10):
+    """
+    tablesがTrueなら表もスライドにする。
+    table_cache_pathには表の解析結果をPDFのハッシュごとに保存する (別プロセスから呼ばれるのでパスで受け取る)
+    """
     output = dir_path.resolve() / f"{id}.md"
+    table_cache = None
+    if tables and table_cache_path is not None:
+        table_cache = DiskCache(table_cache_path, table="tables", ttl=90*24*3600, max_entries=2000)
     with open(output, "w", encoding="utf-8") as f:
         f.write("---\n\n")
         f.write("marp: true\n")
@@ -205,6 +452,11 @@ def make_slides(dir_path, id, summary_dict):
         f.write("size: 16:9\n")
         f.write("paginate: true\n")
 
-        make_md(f, dir_path, summary_dict)
-    output = convert_md_to_pdf(output)
+        make_md(f, dir_path, summary_dict, tables, {"table_time_budget": table_time_budget, "table_cache": table_cache})
+    if table_cache is not None:
+        table_cache.close()
     return output
+
+
+def make_slides(dir_path, id, summary_dict):
+    return convert_md_to_pdf(write_markdown(dir_path, id, summary_dict))
@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from article_meta import make_session
+
+
+class PdfTooLarge(Exception):
+    pass
+
+
+class PdfPrefetcher:
+    """
+    論文のPDFを見つかった時点からバックグラウンドでダウンロードしておく。
+    途中まで書いた分は.partとして残し、再試行や次回の実行ではRangeリクエストで続きから取得する。
+    max_bytesを超えるPDFは途中で打ち切る。
+    """
+
+    def __init__(self, max_workers: int = 4, max_bytes: int = 50 * 1024 * 1024, timeout: float = 60, max_retries: int = 3):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = make_session(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="pdf")
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def _fetch(self, url: str, part: Path) -> None:
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # .partが既に全体だった
+                return
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            length = response.headers.get("content-length")
+            if length is not None and offset + int(length) > self.max_bytes:
+                raise PdfTooLarge(f"{url} is larger than {self.max_bytes} bytes.")
+            size = offset
+            with open(part, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise PdfTooLarge(f"{url} is larger than {self.max_bytes} bytes.")
+                    f.write(chunk)
+
+    def _download(self, url: str, path: Path) -> Path:
+        if path.exists():
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part = path.with_name(path.name + ".part")
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._fetch(url, part)
+                break
+            except PdfTooLarge:
+                part.unlink(missing_ok=True)
+                raise
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Failed to download {url}: {e!r}. Resume in {2 ** attempt} s.")
+                time.sleep(2 ** attempt)
+        part.replace(path)
+        print(f"Downloaded {path.name} ({path.stat().st_size/1e6:.2f} MB) in {time.monotonic() - start:.1f} s.")
+        return path
+
+    def submit(self, url: str, path) -> Future:
+        """PDFのパスのFutureを返す。同じパスへのダウンロードは1回だけ行う"""
+        path = Path(path)
+        with self.lock:
+            if path not in self.futures:
+                self.futures[path] = self.executor.submit(self._download, url, path)
+            return self.futures[path]
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,47 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def iterate_in_background(iterable, maxsize: int = 16):
+    """
+    iterableを別スレッドで回し、要素ができた順に返すジェネレーター。
+    キューの大きさをmaxsizeに制限するので、消費側が遅い場合は生産側が待つ。
+    生産側で起きた例外は消費側で送出する。
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+            else:
+                put(_DONE)
+        except BaseException as e:
+            put(e)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, name="producer", daemon=True)
+    thread.start()
+    try:
+        while (item := q.get()) is not _DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import ConnectionErrorRetryHandler, RateLimitErrorRetryHandler
+
+
+class SlackNotifier:
+    """
+    Slackへの投稿をまとめる。WebClientとアップロード用のSessionは1回の実行で使い回す。
+    ファイルはfiles.getUploadURLExternal → アップロード → files.completeUploadExternalの順で送る。
+    アップロードまではupload()で並列に行い、スレッドへの投稿(complete)は呼んだ順に行うので、
+    投稿の順番はアップロードの終わる順番に左右されない。
+    base_urlをローカルのモックサーバーに向ければオフラインで動作確認できる (tests/test_slack_notifier.py)。
+    """
+
+    def __init__(self, token: str, channel: str, max_uploads: int = 4, max_retries: int = 3,
+                 base_url: str = "https://slack.com/api/", timeout: float = 60):
+        self.channel = channel
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.client = WebClient(token=token, base_url=base_url, retry_handlers=[
+            RateLimitErrorRetryHandler(max_retry_count=max_retries),
+            ConnectionErrorRetryHandler(max_retry_count=max_retries),
+        ])
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_uploads), thread_name_prefix="slack-upload")
+
+    def post(self, text: str, ts: str = None) -> str:
+        try:
+            response = self.client.chat_postMessage(channel=self.channel, text=text, thread_ts=ts)
+        except SlackApiError as e:
+            # スレッドに投稿できなければチャンネルに投稿する
+            print(e)
+            response = self.client.chat_postMessage(channel=self.channel, text=text)
+        return response["ts"]
+
+    def update(self, text: str, ts: str) -> None:
+        try:
+            self.client.chat_update(channel=self.channel, ts=ts, text=text)
+        except SlackApiError as e:
+            print(e)
+
+    def _upload(self, file) -> dict:
+        file = Path(file)
+        length = file.stat().st_size
+        response = self.client.files_getUploadURLExternal(filename=file.name, length=length)
+        upload_url = response["upload_url"]
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            # 再試行のたびにファイルを開き直すので、2回目以降も中身が空にならない
+            with open(file, "rb") as f:
+                upload = self.session.post(upload_url, data=f, timeout=self.timeout,
+                                           headers={"Content-Length": str(length)})
+            if upload.status_code != 429 and upload.status_code < 500 or attempt == self.max_retries:
+                break
+            wait = float(upload.headers.get("retry-after", 2 ** attempt))
+            print(f"Upload of {file.name} failed with {upload.status_code}: retry in {wait:.1f} s.")
+            time.sleep(wait)
+        upload.raise_for_status()
+        print(f"Uploaded {file.name} ({length/1e6:.2f} MB) in {time.monotonic() - start:.1f} s.")
+        return {"id": response["file_id"], "title": file.name}
+
+    def upload(self, file) -> Future:
+        """
+        ファイルをアップロードし、share()に渡すファイルの情報のFutureを返す。まだ投稿はしない。
+        fileにパスのFutureを渡すと、それが完了してからアップロードを始める。
+        """
+        if not isinstance(file, Future):
+            return self.executor.submit(self._upload, file)
+        future = Future()
+
+        def start(f):
+            try:
+                path = f.result()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            self.executor.submit(self._upload, path).add_done_callback(
+                lambda u: future.set_exception(u.exception()) if u.exception() else future.set_result(u.result()))
+
+        file.add_done_callback(start)
+        return future
+
+    def share(self, uploaded: dict, text: str, ts: str = None) -> None:
+        """アップロード済みのファイルをコメント付きで投稿する"""
+        files = [uploaded]
+        try:
+            self.client.files_completeUploadExternal(files=files, channel_id=self.channel, initial_comment=text, thread_ts=ts)
+        except SlackApiError as e:
+            print(e)
+            self.client.files_completeUploadExternal(files=files, channel_id=self.channel, initial_comment=text)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
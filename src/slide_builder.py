@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from make_slide import convert_md_to_pdf, write_markdown
+
+
+class StageTimer:
+    """段階ごとの所要時間を集計する"""
+
+    def __init__(self):
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> str:
+        if not self.times:
+            return "no slides"
+        return ", ".join(f"{stage}: {len(times)} x {sum(times) / len(times):.1f} s (max {max(times):.1f} s)"
+                         for stage, times in self.times.items())
+
+
+def _write_markdown(dir_path, id, summary_dict, options):
+    # 子プロセスで実行する。PDFからの画像や表の取り出しがCPUを使う
+    start = time.monotonic()
+    output = write_markdown(dir_path, id, summary_dict, **options)
+    return output, time.monotonic() - start
+
+
+class SlideBuilder:
+    """
+    スライド作成を3段階に分けて並列に行う。
+    1. prepare: 要約を待ってPDFをダウンロードする (スレッド)
+    2. markdown: PDFから画像を取り出してmarkdownを書く (プロセス)
+    3. render: marpでPDFにする (スレッド、同時実行数はmax_renders)。serverがあればそれに変換させる
+    submit()は最後にできるスライドのパスのFutureを返す。
+    markdown_optionsはwrite_markdownにそのまま渡す。
+    """
+
+    def __init__(self, max_processes: int = None, max_renders: int = 2, max_prepares: int = 4, server=None,
+                 markdown_options: dict = None):
+        self.server = server
+        self.markdown_options = markdown_options or {}
+        self.timer = StageTimer()
+        self.preparer = ThreadPoolExecutor(max_workers=max(1, max_prepares), thread_name_prefix="slide-prepare")
+        # 親プロセスはスレッドを使っているので、forkではなくspawnで子プロセスを作る
+        self.processes = ProcessPoolExecutor(max_workers=max_processes or os.cpu_count() or 1,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        self.renderer = ThreadPoolExecutor(max_workers=max(1, max_renders), thread_name_prefix="slide-render")
+
+    def _prepare(self, future: Future, prepare, args) -> None:
+        start = time.monotonic()
+        try:
+            dir_path, id, summary_dict = prepare(*args)
+            markdown = self.processes.submit(_write_markdown, dir_path, id, summary_dict, self.markdown_options)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.timer.add("prepare", time.monotonic() - start)
+        markdown.add_done_callback(lambda f: self._markdown_done(future, f))
+
+    def _markdown_done(self, future: Future, markdown: Future) -> None:
+        try:
+            md_file, seconds = markdown.result()
+            self.timer.add("markdown", seconds)
+            self.renderer.submit(self._render, future, md_file)
+        except Exception as e:
+            future.set_exception(e)
+
+    def _render(self, future: Future, md_file) -> None:
+        start = time.monotonic()
+        try:
+            output = convert_md_to_pdf(md_file, self.server)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.timer.add("render", time.monotonic() - start)
+        future.set_result(output)
+
+    def submit(self, prepare, *args) -> Future:
+        """prepare(*args)は(ディレクトリ, id, summary_dict)を返す関数"""
+        future = Future()
+        self.preparer.submit(self._prepare, future, prepare, args)
+        return future
+
+    def close(self) -> None:
+        self.preparer.shutdown(wait=True)
+        self.processes.shutdown(wait=True)
+        self.renderer.shutdown(wait=True)
+        print(f"Slide timings: {self.timer.summary()}")
@@ -1,25 +1,32 @@
 import argparse
 import datetime
+import json
 import os
 import re
 import time
-import urllib.parse
 import warnings
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 
-from make_slide import make_slides
-import arxiv
+from make_slide import MarpServer
+from slide_builder import SlideBuilder
+from slack_notifier import SlackNotifier
+from pdf_prefetcher import PdfPrefetcher
+from dedup_index import DedupIndex
+from arxiv_mirror import ArxivMirror, ArxivPaper, search_day
+from keyword_matcher import KeywordMatcher
+from cache import DiskCache, text_hash
+from translator import make_driver, make_translator
+from feed_fetcher import FeedState, fetch_and_parse_feeds
+from pipeline import iterate_in_background
+from summarizer import Summarizer
+from summary_parser import fill_missing, missing_fields, normalize_summary, parse_json_summary, parse_summary
+from article_meta import fetch_article_pages, get_abstract, get_meta, get_publication_date, make_session, page_from_driver
 from openai import OpenAI
 
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-from io import BytesIO
 
 import yaml
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from webdriver_manager.firefox import GeckoDriverManager
-from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.common.by import By
 from pathlib import Path
 import feedparser
@@ -35,78 +42,132 @@ class Result:
     source: type = None
     res: dict = None
     abst_jp: str = None
+    pdf: Future = None
+    links: list = None
 
 
-PROMPT = """与えられた論文の要点をまとめ、以下の項目で日本語で出力せよ。それぞれの項目は最大でも180文字以内に要約せよ。
+PROMPT = """与えられた論文の要点をまとめ、以下の項目を持つJSONとして日本語で出力せよ。それぞれの項目は最大でも180文字以内に要約せよ。
 
-論文名:タイトルの日本語訳
-キーワード:この論文のキーワード
-課題:この論文が解決する課題
-手法:この論文が提案する手法
-結果:提案手法によって得られた結果
+title_jp:タイトルの日本語訳
+keywords:この論文のキーワード
+problem:この論文が解決する課題
+method:この論文が提案する手法
+result:提案手法によって得られた結果
+terminology:要約内に登場する主要な専門用語について、高校生にもわかるような説明の配列。日本語だけでなく、翻訳元の英語表記も添えよ。
+"""
+REASK_PROMPT = """与えられた論文の要約のうち、次の項目が欠けていた。欠けていた項目だけを持つJSONとして日本語で出力せよ。それぞれの項目は最大でも180文字以内に要約せよ。
 
-さらに要約内に登場する主要な専門用語について、高校生にもわかるような説明を付け加えよ。日本語だけでなく、翻訳元の英語表記も添えよ。それぞれの用語について、説明の終わりにのみ改行記号を用いよ。
+{fields}
+"""
+FIELD_DESCRIPTIONS = {
+    "title_jp": "タイトルの日本語訳",
+    "keywords": "この論文のキーワード",
+    "problem": "この論文が解決する課題",
+    "method": "この論文が提案する手法",
+    "result": "提案手法によって得られた結果",
+}
+TEMPERATURE = 0.25
+BATCH_PROMPT = """与えられた複数の論文それぞれについて要点をまとめ、日本語で出力せよ。それぞれの項目は最大でも180文字以内に要約せよ。
+論文はid, title, bodyを持つJSONの配列として与えられる。出力は次の形式のJSONとし、papersには全ての論文を含めよ。
+
+{"papers": [{"id": 論文のid, "title_jp": "タイトルの日本語訳", "keywords": "この論文のキーワード", "problem": "この論文が解決する課題", "method": "この論文が提案する手法", "result": "提案手法によって得られた結果", "terminology": ["用語の説明", ...]}]}
+
+terminologyには要約内に登場する主要な専門用語について、高校生にもわかるような説明を記述せよ。日本語だけでなく、翻訳元の英語表記も添えよ。
 """
 BASE_DIR=Path("./files")
+CACHE_DIR=Path("./cache")
 CHANNEL_ID = "C03KGQE0FT6"
 
 
-def calc_score(abst: str, keywords: dict):
-    sum_score = 0.0
-    hit_kwd_list = []
+def calc_score(abst: str, matcher: KeywordMatcher):
+    """matcherは呼び出し側でキーワードごとに一度だけ作る"""
+    return matcher(abst)
 
-    for word in keywords.keys():
-        score = keywords[word]
-        if (word in abst) or (not word.isupper() and word.lower() in abst.lower()):
-            sum_score += score
-            hit_kwd_list.append(word)
-    return sum_score, hit_kwd_list
 
+def get_translation(result, translator) -> str:
+    abst_jp = result.abst_jp
+    if isinstance(abst_jp, Future):
+        if not abst_jp.done():
+            # まとめて翻訳するバックエンドで、まだ送られていない分を送る
+            translator.flush()
+        try:
+            abst_jp = abst_jp.result()
+        except Exception as e:
+            print(e)
+            abst_jp = ""
+    return abst_jp
 
-def get_text_from_driver(driver) -> str:
-    try:
-        elem = driver.find_element(by=By.XPATH, value='//*[@id="textareasContainer"]/div[3]/section/div[1]/d-textarea/div')
-    except NoSuchElementException as e:
-        print(e)
-        return None
-    text = elem.get_attribute("textContent")
-    return text
 
-def get_translated_text(from_lang: str, to_lang: str, from_text: str, driver) -> str:
-    sleep_time = 1
-    from_text = urllib.parse.quote(from_text)
-    url = "https://www.deepl.com/translator#" \
-        + from_lang + "/" + to_lang + "/" + from_text
+def resolve_translation(result, translator) -> None:
+    result.abst_jp = get_translation(result, translator)
 
-    driver.get(url)
-    driver.implicitly_wait(10)
-    driver.set_page_load_timeout(10)
 
-    for i in range(30):
-        time.sleep(sleep_time)
-        to_text = get_text_from_driver(driver)
-        if to_text:
-            break
-    if to_text is None:
-        return urllib.parse.unquote(from_text)
-    return to_text
+def arxiv_id(article) -> str:
+    return article.get_short_id().replace(".", "_")
+
+
+def get_link(result) -> str:
+    if result.source == "arxiv":
+        return result.res.entry_id
+    return result.res["link"]
+
+
+def get_doi(result) -> str:
+    if result.source == "arxiv":
+        return result.res.doi
+    return result.res.get("doi") or result.res.get("prism_doi") or result.res.get("citation_doi")
+
+
+def merge_duplicate(result, dedup) -> bool:
+    """
+    dedupに同じ論文が登録されていれば、スコアの高い方とリンクをそちらにまとめてTrueを返す。
+    なければresultを登録してFalseを返す。翻訳や要約の前に呼んで、同じ論文を2回処理しないようにする。
+    """
+    if dedup is None:
+        return False
+    title = result.res.title if result.source == "arxiv" else result.res["title"]
+    doi = get_doi(result)
+    # arXivのIDはバージョンを除いて比べる
+    id = re.sub(r"v\d+$", "", result.res.get_short_id()) if result.source == "arxiv" else None
+    original = dedup.find(doi, title, result.source, id)
+    if original is None:
+        dedup.add(result, doi, title, result.source, id)
+        return False
+    original.score = max(original.score, result.score)
+    original.hit_keywords = original.hit_keywords + [word for word in result.hit_keywords if word not in original.hit_keywords]
+    original.links = (original.links or []) + [(result.source, get_link(result))]
+    if doi:
+        # 同じ論文の別の版もDOIで見つかるようにする
+        dedup.add(original, doi)
+    print(f"{title.strip()} from {result.source} is the same paper as {get_link(original)}.")
+    return True
 
 
 def search_keyword(
-        driver, articles: list, keywords: dict, score_threshold: float
+        translator, articles, keywords: dict, score_threshold: float, prefetcher=None, dedup=None
         ):
-    results = []
+    """
+    articlesはarxiv.ResultかArxivPaperのイテラブル。1件ずつスコアを計算し、
+    閾値を超えたものだけを必要な属性だけのArxivPaperにして残す。
+    """
+    matcher = KeywordMatcher(keywords)
     for article in articles:
         abstract = article.summary.replace("\n", " ")
-        score, hit_keywords = calc_score(abstract, keywords)
+        score, hit_keywords = calc_score(abstract, matcher)
         if score < score_threshold:
             continue
-        abstract_trans = get_translated_text("en", "ja", abstract, driver)
 
-        article.authors = ", ".join([author.name for author in article.authors])
-        result = Result(score=score, hit_keywords=hit_keywords, source="arxiv", res=article, abst_jp=abstract_trans)
-        results.append(result)
-    return results
+        if not isinstance(article, ArxivPaper):
+            article = ArxivPaper.from_result(article)
+        result = Result(score=score, hit_keywords=hit_keywords, source="arxiv", res=article)
+        if merge_duplicate(result, dedup):
+            continue
+        result.abst_jp = translator.submit("en", "ja", abstract)
+        if prefetcher is not None:
+            # スライドを作る時には手元にあるように、見つけた時点でPDFのダウンロードを始める
+            id = arxiv_id(article)
+            result.pdf = prefetcher.submit(article.pdf_url, BASE_DIR/id/f"{id}.pdf")
+        yield result
 
 
 def ecs_login(driver, url, ecs_info):
@@ -126,9 +187,9 @@ def ecs_login(driver, url, ecs_info):
     print(driver.page_source)
 
 
-def parse_iop_rss(driver, rss_url_list: list, keywords: dict, score_threshold: float, ecs_info: list[str, str]):
-    results = []
+def parse_iop_rss(driver, translator, rss_url_list: list, keywords: dict, score_threshold: float, ecs_info: list[str, str], feed_state=None, dedup=None):
     yesterday = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    matcher = KeywordMatcher(keywords)
 
     for i, url in enumerate(rss_url_list):
         if i==0:
@@ -139,110 +200,167 @@ def parse_iop_rss(driver, rss_url_list: list, keywords: dict, score_threshold: f
 
         d = feedparser.parse(driver.page_source)
         print(f"{len(d['entries'])} articles are found in RSS feed.")
+        if feed_state is not None:
+            feed_state.drop_seen(url, d)
         for entry in d["entries"]:
-            if time.strftime("%Y-%m-%d", entry["updated_parsed"]) != yesterday:
+            date = time.strftime("%Y-%m-%d", entry["updated_parsed"])
+            if feed_state is not None and date <= yesterday:
+                feed_state.mark_seen(url, entry)
+            if date != yesterday:
                 print(f"{entry['title']} is updated at {entry['updated']}.")
                 continue
             abstract = entry["summary"].replace("\n", " ")
-            score, hit_keywords = calc_score(abstract, keywords)
+            score, hit_keywords = calc_score(abstract, matcher)
             if score < score_threshold:
                 print(f"Score of {entry['title']} is {score}.")
                 continue
             entry["authors"] = entry["authors"][0]["name"]
-            abstract_trans = get_translated_text("en", "ja", abstract, driver)
-            result = Result(score=score, hit_keywords=hit_keywords, source="iop", res=entry, abst_jp=abstract_trans)
-            results.append(result)
+            result = Result(score=score, hit_keywords=hit_keywords, source="iop", res=entry)
+            if merge_duplicate(result, dedup):
+                continue
+            result.abst_jp = translator.submit("en", "ja", abstract)
+            yield result
+
 
-    return results
+
+def get_rss_online_date(entry):
+    """ElsevierのRSSの "Publication date: Available online 14 May 2024" から日付を取り出す"""
+    m = re.search(r"Available online (\d{1,2} [A-Za-z]+ \d{4})", entry.get("summary", ""))
+    if m is None:
+        return None
+    try:
+        return datetime.datetime.strptime(m.group(1), "%d %B %Y").date()
+    except ValueError:
+        return None
 
 
-def parse_elsevier_rss(driver, rss_url_list: list, keywords: dict, score_threshold: float):
-    results = []
+def parse_elsevier_rss(driver, translator, rss_url_list: list, keywords: dict, score_threshold: float, feeds: dict = None, feed_state=None, dedup=None):
     yesterday = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    matcher = KeywordMatcher(keywords)
     p = r'<p>(.*?)</p>'
+    # RSSの日付は論文ページの日付と1日ずれることがあるので、余裕を持たせて古いものだけ除く
+    cutoff = datetime.date.today() - datetime.timedelta(days=3)
+    session = make_session()
+
+    # スコアはアブストから計算するので、全キーワードが当たっても閾値に届かなければページを取得する意味がない
+    if sum(max(0, score) for score in keywords.values()) < score_threshold:
+        print("score_threshold cannot be reached by any Elsevier article.")
+        return
 
     for i, url in enumerate(rss_url_list):
-        d = feedparser.parse(url)
+        d = feeds[url] if feeds is not None else feedparser.parse(url)
+        if d is None:
+            continue
         print(f"{len(d['entries'])} articles are found in RSS feed.")
+        entries = []
         for entry in d["entries"]:
+            online_date = get_rss_online_date(entry)
+            if online_date is not None and online_date < cutoff:
+                if feed_state is not None:
+                    feed_state.mark_seen(url, entry)
+                continue
+            entries.append(entry)
+        n_old = len(d["entries"]) - len(entries)
+        n_date = n_score = n_error = 0
+
+        # 論文ページはまとめてHTTPで取得し、取れなかったものだけブラウザで開く
+        pages = fetch_article_pages(session, [entry["link"] for entry in entries])
+        for entry, page in zip(entries, pages):
             try:
-                driver.get(entry["link"])
-                try:
-                    entry["updated"] = driver.find_element(by=By.XPATH, value='//meta[@name="citation_online_date"]').get_attribute('content')
-                except:
-                    entry["updated"] = driver.find_element(by=By.XPATH, value='//meta[@name="citation_date"]').get_attribute('content')
-                        
+                from_driver = False
+                if page is None or get_publication_date(page) is None:
+                    page = page_from_driver(driver, entry["link"])
+                    from_driver = True
+                entry["updated"] = get_publication_date(page)
                 entry["updated_parsed"] = datetime.datetime.strptime(entry["updated"], "%Y/%m/%d").timetuple()
-                if time.strftime("%Y-%m-%d", entry["updated_parsed"]) != yesterday:
+                date = time.strftime("%Y-%m-%d", entry["updated_parsed"])
+                if feed_state is not None and date <= yesterday:
+                    feed_state.mark_seen(url, entry)
+                if date != yesterday:
                     # print(f"{entry['title']} is updated at {entry['updated']}.")
+                    n_date += 1
                     continue
-                abstract = driver.find_element(by=By.XPATH, value='//h2[text()="Abstract"]/following-sibling::div').text.replace("\n", " ")
+                abstract = get_abstract(page)
+                if abstract is None and not from_driver:
+                    page = page_from_driver(driver, entry["link"])
+                    abstract = get_abstract(page)
                 entry["summary"] = abstract
-                entry["doi"] = driver.find_element(by=By.XPATH, value='//meta[@name="citation_doi"]').get_attribute('content')
+                entry["doi"] = get_meta(page, "citation_doi")
                 ## EJDB適用後のリンクでrssのURLを記載しておき、iopと同様にログインするようにすればPDFリンクも取得できると思うが、結局規約的にPDFダウンロードは避けているため使わない
                 # try:
                 #     entry["pdf_url"] = driver.find_element(by=By.XPATH, value='//*[@class="ViewPDF"]//a[1]').get_attribute('href')
                 # except Exception as e:
                 #     entry["pdf_url"] = ""
                 entry["pdf_url"] = ""
-                score, hit_keywords = calc_score(abstract, keywords)
+                score, hit_keywords = calc_score(abstract, matcher)
                 if score < score_threshold:
                     print(f"Score of {entry['title']} is {score}.")
+                    n_score += 1
                     continue
-                abstract_trans = get_translated_text("en", "ja", abstract, driver)
-                
                 entry["authors"] = re.findall(p, entry["summary_detail"]["value"])[-1].removeprefix("Author(s): ")
                 entry["link"] = entry["id"]
                 entry["updated"] = d["updated"]
                 entry["updated_parsed"] = d["updated_parsed"]
-                result = Result(score=score, hit_keywords=hit_keywords, source="elsevier", res=entry, abst_jp=abstract_trans)
-                results.append(result)
+                result = Result(score=score, hit_keywords=hit_keywords, source="elsevier", res=entry)
+                if merge_duplicate(result, dedup):
+                    continue
+                result.abst_jp = translator.submit("en", "ja", abstract)
+                yield result
 
             except Exception as e:
                 print(e)
+                n_error += 1
                 continue
-                
-    return results
 
+        print(f"{n_old} entries were skipped by the RSS date, {len(entries)} pages were fetched, "
+              f"{n_date} were skipped by the page date, {n_score} by the score and {n_error} by errors.")
 
-def parse_cambridge_rss(rss_url_list: list, keywords: dict, score_threshold: float):
-    results = []
+    session.close()
+
+
+def parse_cambridge_rss(translator, rss_url_list: list, keywords: dict, score_threshold: float, feeds: dict = None, feed_state=None, dedup=None):
     yesterday = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    matcher = KeywordMatcher(keywords)
     p = r'<p>(.*?)</p>'
 
     for i, url in enumerate(rss_url_list):
-        d = feedparser.parse(url)
+        d = feeds[url] if feeds is not None else feedparser.parse(url)
+        if d is None:
+            continue
         print(f"{len(d['entries'])} articles are found in RSS feed.")
         for entry in d["entries"]:
             try:
-                if time.strftime("%Y-%m-%d", entry["updated_parsed"]) != yesterday:
+                date = time.strftime("%Y-%m-%d", entry["updated_parsed"])
+                if feed_state is not None and date <= yesterday:
+                    feed_state.mark_seen(url, entry)
+                if date != yesterday:
                     # print(f"{entry['title']} is updated at {entry['updated']}.")
                     continue
                 if m := re.match(p, entry["summary"]):
                     abstract = m.group()
                 else:
                     abstract = entry["summary"]
-                score, hit_keywords = calc_score(abstract, keywords)
+                score, hit_keywords = calc_score(abstract, matcher)
                 if score < score_threshold:
                     print(f"Score of {entry['title']} is {score}.")
                     continue
-                abstract_trans = get_translated_text("en", "ja", abstract, driver)
-                
                 entry["summary"] = abstract
                 entry["doi"] = entry["prism_doi"]
                 entry["pdf_url"] = ""
                 entry["authors"] = ", ".join([author["name"].replace(",", "") for author in entry["authors"]])
-                result = Result(score=score, hit_keywords=hit_keywords, source="cambridge", res=entry, abst_jp=abstract_trans)
-                results.append(result)
+                result = Result(score=score, hit_keywords=hit_keywords, source="cambridge", res=entry)
+                if merge_duplicate(result, dedup):
+                    continue
+                result.abst_jp = translator.submit("en", "ja", abstract)
+                yield result
 
             except Exception as e:
                 print(e)
                 continue
                 
-    return results
 
 
-def get_summary(result, client):
+def get_title_and_body(result):
     res = result.res
     if result.source == "arxiv":
         title = res.title.replace("\n ", "")
@@ -250,39 +368,143 @@ def get_summary(result, client):
     else:
         title = res["title"].replace("\n ", "")
         body = res["summary"].replace("\n", " ")
+    return title, body
+
+
+def get_cached_summary(summarizer, title, body):
+    if summarizer.cache is None:
+        return None
+    cached = summarizer.cache.get(text_hash(summarizer.model, PROMPT, TEMPERATURE, title, body))
+    return None if cached is None else dict(cached["fields"])
+
+
+def set_cached_summary(summarizer, title, body, completion, summary_dict):
+    if summarizer.cache is not None:
+        summarizer.cache.set(text_hash(summarizer.model, PROMPT, TEMPERATURE, title, body),
+                             {"completion": completion, "fields": summary_dict})
+
+
+def get_summary(result, summarizer):
+    title, body = get_title_and_body(result)
+    summary_dict = get_cached_summary(summarizer, title, body)
+    if summary_dict is None:
+        text = f"title: {title}\nbody: {body}"
+        summary = summarizer.complete([
+            {"role": "system", "content": PROMPT},
+            {"role": "user", "content": text}
+        ], temperature=TEMPERATURE, response_format={"type": "json_object"})
+        summary_dict = complete_summary(summarizer, title, body, parse_summary(summary))
+        if not missing_fields(summary_dict):
+            set_cached_summary(summarizer, title, body, summary, summary_dict)
+    return add_metadata(fill_missing(summary_dict), result, body)
+
+
+def complete_summary(summarizer, title: str, body: str, summary_dict: dict) -> dict:
+    """
+    欠けている項目だけを1回聞き直す。
+    それでも埋まらなければそのまま返し、スライドは空の項目で作る。
+    """
+    missing = missing_fields(summary_dict)
+    if not missing:
+        return summary_dict
+    print(f"Missing {', '.join(missing)} in the summary of {title}. Ask again.")
+    fields = "\n".join(f"{field}:{FIELD_DESCRIPTIONS[field]}" for field in missing)
+    try:
+        summary = summarizer.complete([
+            {"role": "system", "content": REASK_PROMPT.format(fields=fields)},
+            {"role": "user", "content": f"title: {title}\nbody: {body}"}
+        ], temperature=TEMPERATURE, response_format={"type": "json_object"})
+    except Exception as e:
+        print(e)
+        return summary_dict
+    answer = parse_summary(summary)
+    for field in missing:
+        if answer.get(field):
+            summary_dict[field] = answer[field]
+    if missing := missing_fields(summary_dict):
+        print(f"Still missing {', '.join(missing)} in the summary of {title}.")
+    return summary_dict
+
+
+def parse_batch_summary(summary: str, n_papers: int) -> tuple:
+    """
+    まとめて要約した結果のJSONを論文ごとに分け、(summary_dictのリスト, 論文ごとの生の出力のリスト)を返す。
+    生の出力は、応答のうちその論文の部分を正規化する前のままJSONにしたもの。
+    読み取れなかった論文はどちらもNoneになる。項目が欠けていてもそのまま返す。
+    """
+    summary_dicts = [None] * n_papers
+    completions = [None] * n_papers
+    data = parse_json_summary(summary)
+    papers = data.get("papers") if data is not None else None
+    if not isinstance(papers, list):
+        print("Failed to parse batch summary.")
+        return summary_dicts, completions
+    for paper in papers:
+        if not isinstance(paper, dict):
+            continue
+        # JSONモードでは "id": "0" のように文字列で返ってくることもある
+        try:
+            i = int(paper.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if isinstance(paper.get("id"), bool) or not 0 <= i < n_papers:
+            continue
+        summary_dict = normalize_summary(paper)
+        if summary_dict:
+            summary_dicts[i] = summary_dict
+            completions[i] = json.dumps(paper, ensure_ascii=False)
+    return summary_dicts, completions
+
+
+def get_summaries(results: list, summarizer) -> list:
+    """
+    複数の論文をまとめて1回のリクエストで要約する。
+    まとめた結果から取り出せなかった論文だけ1件ずつ要約し直す。
+    """
+    inputs = [get_title_and_body(result) for result in results]
+    summary_dicts = [get_cached_summary(summarizer, title, body) for title, body in inputs]
+    missing = [i for i, summary_dict in enumerate(summary_dicts) if summary_dict is None]
+
+    if len(missing) > 1:
+        papers = [{"id": j, "title": inputs[i][0], "body": inputs[i][1]} for j, i in enumerate(missing)]
+        try:
+            summary = summarizer.complete([
+                {"role": "system", "content": BATCH_PROMPT},
+                {"role": "user", "content": json.dumps(papers, ensure_ascii=False)}
+            ], temperature=TEMPERATURE, response_format={"type": "json_object"})
+            parsed, completions = parse_batch_summary(summary, len(missing))
+        except Exception as e:
+            print(e)
+            parsed = completions = [None] * len(missing)
+        for i, summary_dict, completion in zip(missing, parsed, completions):
+            if summary_dict is not None:
+                title, body = inputs[i]
+                summary_dict = complete_summary(summarizer, title, body, summary_dict)
+                if not missing_fields(summary_dict):
+                    # 1件ずつの場合と同じく、整形した項目ではなくモデルの出力を残す
+                    set_cached_summary(summarizer, title, body, completion, summary_dict)
+                summary_dicts[i] = summary_dict
+        n_failed = sum(summary_dict is None for summary_dict in parsed)
+        if n_failed:
+            print(f"{n_failed} of {len(missing)} papers were not in the batch summary. Summarize them one by one.")
+
+    outputs = []
+    for result, (title, body), summary_dict in zip(results, inputs, summary_dicts):
+        try:
+            if summary_dict is None:
+                outputs.append(get_summary(result, summarizer))
+            else:
+                outputs.append(add_metadata(fill_missing(summary_dict), result, body))
+        except Exception as e:
+            outputs.append(e)
+    return outputs
 
-    text = f"title: {title}\nbody: {body}"
-    response = client.chat.completions.create(
-    model="gpt-4o-mini",
-    messages=[
-        {"role": "system", "content": PROMPT},
-        {"role": "user", "content": text}
-    ],
-    temperature=0.25)
-    summary = response.choices[0].message.content
-    summary_dict = {}
-    summary_dict["terminology"] = []
-    i_result = -1
-    for i, b in enumerate(summary.split("\n")):
-        if b.startswith("論文名"):
-            summary_dict["title_jp"] = b[4:].lstrip()
-        if b.startswith("キーワード"):
-            summary_dict["keywords"] = b[6:].lstrip()
-        if b.startswith("課題"):
-            summary_dict["problem"] = b[3:].lstrip()
-        if b.startswith("手法"):
-            summary_dict["method"] = b[3:].lstrip()
-        if b.startswith("結果"):
-            summary_dict["result"] = b[3:].lstrip()
-            i_result = i
-    if i_result != -1:
-        for b in summary.split("\n")[i_result+1:]:
-            b.replace("`", "")
-            summary_dict["terminology"].append(b)
 
+def add_metadata(summary_dict: dict, result, body: str) -> dict:
+    res = result.res
     if result.source == "arxiv":
         summary_dict["title"]= res.title
-        summary_dict["id"] = res.get_short_id().replace(".", "_")
+        summary_dict["id"] = arxiv_id(res)
         summary_dict["date"] = res.published.strftime("%Y-%m-%d %H:%M:%S")
         summary_dict["authors"] = res.authors
         summary_dict["year"] = str(res.published.year)
@@ -319,106 +541,159 @@ def get_summary(result, client):
     return summary_dict
 
 
-def send2app(text: str, slack_token: str, file: str=None, ts: str=None) -> None:
-    if slack_token is not None:
-        client = WebClient(token=slack_token)
-        if file is None:
-            try:
-                new_message = client.chat_postMessage(
-                    channel=CHANNEL_ID,
-                    text=text,
-                    thread_ts=ts,
-                )
-            except SlackApiError as e:
-                new_message = client.chat_postMessage(
-                    channel=CHANNEL_ID,
-                    text=text,
-                )
-            return new_message["ts"]
-        else:
-            print(file)
-            with open(file, "rb") as f:
-                try:
-                    new_file = client.files_upload(
-                        channels=CHANNEL_ID,
-                        file=BytesIO(f.read()),
-                        filename=file.name,
-                        filetype="pdf",
-                        initial_comment=text,
-                        thread_ts=ts,
-                    )
-
-                except SlackApiError as e:
-                    new_file = client.files_upload(
-                        channels=CHANNEL_ID,
-                        file=BytesIO(f.read()),
-                        filename=file.name,
-                        filetype="pdf",
-                        initial_comment=text,
-                    )
+def send2app(text: str, notifier, upload=None, ts: str=None) -> str:
+    """
+    uploadはSlackNotifier.upload()のFuture。スライドが無い場合や作れなかった場合は本文だけ投稿する。
+    """
+    if notifier is None:
+        return None
+    if upload is not None:
+        try:
+            notifier.share(upload.result(), text, ts)
             return None
+        except Exception as e:
+            print(e)
+    return notifier.post(text, ts)
+
 
+STAR = "*"*80
+
+
+def update_message(text: str, notifier, ts: str) -> None:
+    if notifier is not None and ts is not None:
+        notifier.update(text, ts)
+
+
+def submit_summary(result, summarizer):
+    if summarizer is None:
+        return None
+    if summarizer.batch_size > 1:
+        return summarizer.submit_batched(lambda results: get_summaries(results, summarizer), result)
+    return summarizer.submit(get_summary, result, summarizer)
+
+
+def prepare_slide(result, summary, translator):
+    """要約と翻訳を待ち、arXivの論文ならPDFのダウンロードを待つ。SlideBuilderの最初の段階で呼ばれる"""
+    summary_dict = summary.result()
+    summary_dict["abst_jp"] = get_translation(result, translator)
+    id = summary_dict["id"]
+    dirpath = BASE_DIR/id
+    dirpath.mkdir(parents=True, exist_ok=True)
+    if result.source == "arxiv":
+        # スライドを作るのはOpenAIのキーがある時だけで、その時はsearch_keywordで必ずprefetcherに渡している
+        summary_dict["pdf"] = str(result.pdf.result())
+    else:
+        print("Downloading pdf file should be done manually.")
+        summary_dict["pdf"] = None
+    return dirpath, id, summary_dict
 
-def notify(results: list, slack_token: str, openai_api: str) -> None:
-    star = "*"*80
+
+def submit_slide(result, summary, translator, slide_builder):
+    if summary is None or slide_builder is None:
+        return None
+    return slide_builder.submit(prepare_slide, result, summary, translator)
+
+
+def submit_upload(slide, notifier):
+    if slide is None or notifier is None:
+        return None
+    return notifier.upload(slide)
+
+
+def notify_result(result, notifier, upload, ts: str) -> None:
+    star = STAR
+    if result.source == "arxiv":
+        url = result.res.entry_id
+        title = result.res.title.replace("\n ", "")
+        abstract_en = result.res.summary.replace("\n", " ").replace(". ", ". \n>")
+        authors = result.res.authors
+    else:
+        url = result.res["link"]
+        title = result.res["title"].replace("\n ", "")
+        abstract_en = result.res["summary"].replace("\n", " ").replace(". ", ". \n>")
+        authors = result.res["authors"]
+    word = result.hit_keywords
+    score = result.score
+    # 別の情報源で見つかった同じ論文のリンク
+    other_links = "".join(f"\n Also in {source}: {link}" for source, link in result.links or [])
+    abstract = result.abst_jp.replace("。", "。\n>")
+    if len(abstract) > 0:
+        if abstract[-1] == "\n>":
+            abstract = abstract.rstrip("\n>")
+
+    text = f"\n Score: `{score}`"\
+           f"\n Hit keywords: `{word}`"\
+           f"\n URL: {url}"\
+           f"{other_links}"\
+           f"\n Title: {title}"\
+           f"\n Authors: {authors}"\
+           f"\n Abstract:"\
+           f"\n>{abstract}"\
+           f"\n Original:"\
+           f"\n>{abstract_en}"\
+           f"\n {star}"
+
+    send2app(text, notifier, upload, ts=ts)
+
+
+def notify(results: list, translator, notifier, summarizer, slide_builder) -> None:
+    star = STAR
     today = datetime.date.today()
     n_articles = len(results)
     text = f"{star}\n \t \t {today}\tnum of articles = {n_articles}\n{star}"
-    ts = send2app(text, slack_token)
-    if openai_api is not None:
-        client = OpenAI(api_key=openai_api)
-    else:
-        client = None
-
-    for result in sorted(results, reverse=True, key=lambda x: x.score):
+    ts = send2app(text, notifier)
+
+    # 要約、スライド作成とアップロードは先に全て投げておき、投稿はスコア順に行う
+    results = sorted(results, reverse=True, key=lambda x: x.score)
+    slides = [submit_slide(result, submit_summary(result, summarizer), translator, slide_builder) for result in results]
+    uploads = [submit_upload(slide, notifier) for slide in slides]
+    if summarizer is not None:
+        summarizer.flush()
+    for result, upload in zip(results, uploads):
+        notify_result(result, notifier, upload, ts)
+
+
+def notify_stream(results, translator, notifier, summarizer, slide_builder, final_ranking: bool = True, window: int = 8) -> None:
+    """
+    見つかった順に通知する。件数は最初は分からないので、最後にヘッダーを書き換える。
+    要約、スライド作成とアップロードは見つかった時点で投げ、最大window件まで先行させる。
+    final_rankingがTrueなら、最後にスコア順の一覧をスレッドに投稿する。
+    """
+    star = STAR
+    today = datetime.date.today()
+    ts = send2app(f"{star}\n \t \t {today}\tsearching...\n{star}", notifier)
+
+    ranking = []
+    pending = deque()
+    start = time.monotonic()
+
+    def post(result, slide, upload):
+        if slide is not None and not slide.done():
+            # まとめて要約する場合に、まだ送られていない分を送る
+            summarizer.flush()
+        resolve_translation(result, translator)
+        notify_result(result, notifier, upload, ts)
+        if not ranking:
+            print(f"First notification was sent in {time.monotonic() - start:.1f} s.")
         if result.source == "arxiv":
-            url = result.res.entry_id
-            title = result.res.title.replace("\n ", "")
-            abstract_en = result.res.summary.replace("\n", " ").replace(". ", ". \n>")
-            authors = result.res.authors
+            ranking.append((result.score, result.res.title.replace("\n ", ""), result.res.entry_id))
         else:
-            url = result.res["link"]
-            title = result.res["title"].replace("\n ", "")
-            abstract_en = result.res["summary"].replace("\n", " ").replace(". ", ". \n>")
-            authors = result.res["authors"]
-        word = result.hit_keywords
-        score = result.score
-        abstract = result.abst_jp.replace("。", "。\n>")
-        if len(abstract) > 0:
-            if abstract[-1] == "\n>":
-                abstract = abstract.rstrip("\n>")
-
-        text = f"\n Score: `{score}`"\
-               f"\n Hit keywords: `{word}`"\
-               f"\n URL: {url}"\
-               f"\n Title: {title}"\
-               f"\n Authors: {authors}"\
-               f"\n Abstract:"\
-               f"\n>{abstract}"\
-               f"\n Original:"\
-               f"\n>{abstract_en}"\
-               f"\n {star}"
-
-        file = None
-        if client:
-            try:
-                summary_dict = get_summary(result, client)
-                summary_dict["abst_jp"] = result.abst_jp
-                id = summary_dict["id"]
-                dirpath = BASE_DIR/id
-                dirpath.mkdir(parents=True, exist_ok=True)
-                pdf = f"{id}.pdf"
-                if result.source == "arxiv":
-                    result.res.download_pdf(dirpath=str(dirpath), filename=pdf)
-                    summary_dict["pdf"] = str(dirpath/pdf)
-                else:
-                    print("Downloading pdf file should be done manually.")
-                    summary_dict["pdf"] = None
+            ranking.append((result.score, result.res["title"].replace("\n ", ""), result.res["link"]))
+
+    for result in results:
+        slide = submit_slide(result, submit_summary(result, summarizer), translator, slide_builder)
+        pending.append((result, slide, submit_upload(slide, notifier)))
+        while pending and (len(pending) > window or pending[0][2] is None or pending[0][2].done()):
+            post(*pending.popleft())
+    while pending:
+        post(*pending.popleft())
+
+    n_articles = len(ranking)
+    update_message(f"{star}\n \t \t {today}\tnum of articles = {n_articles}\n{star}", notifier, ts)
+    if final_ranking and n_articles > 1:
+        lines = [f"`{score}` <{url}|{title}>" for score, title, url in sorted(ranking, reverse=True, key=lambda x: x[0])]
+        send2app("Ranking:\n" + "\n".join(lines), notifier, ts=ts)
 
-                file = make_slides(dirpath, id, summary_dict)
-            except Exception as e:
-                print(e)
-        send2app(text, slack_token, file, ts=ts)
 
 def get_config():
     file_abs_path = os.path.abspath(__file__)
@@ -436,6 +711,8 @@ def main():
     parser.add_argument("--openai_api", default=None)
     parser.add_argument("--ecs_id", default=None)
     parser.add_argument("--ecs_password", default=None)
+    parser.add_argument("--deepl_api", default=None)
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="翻訳と要約のキャッシュを使わない")
     args = parser.parse_args()
 
     config = get_config()
@@ -447,56 +724,159 @@ def main():
     cambridge_rss_url = config.get("cambridge_rss_url", [])
     ecs_id = os.getenv("ECS_ID") or args.ecs_id
     ecs_pass = os.getenv("ECS_PASSWORD") or args.ecs_password
-
-    options = webdriver.FirefoxOptions()
-    options.add_argument("-headless")
-    firefox_profile = webdriver.firefox.firefox_profile.FirefoxProfile()
-    firefox_profile.set_preference("browser.privatebrowsing.autostart", True)
-    options.profile = firefox_profile
-    driver = webdriver.Firefox(service=Service(GeckoDriverManager().install()), options=options)
-    driver.implicitly_wait(10)
-    driver.set_page_load_timeout(10)
+    translation_cache = None
+    summary_cache = None
+    if not args.no_cache:
+        cache_config = config.get("translation_cache", {})
+        translation_cache = DiskCache(
+            CACHE_DIR/"translation.sqlite3", table="translation",
+            ttl=float(cache_config.get("ttl_days", 30))*24*3600,
+            max_entries=int(cache_config.get("max_entries", 20000)))
+        cache_config = config.get("summary_cache", {})
+        summary_cache = DiskCache(
+            CACHE_DIR/"summary.sqlite3", table="summary",
+            ttl=float(cache_config.get("ttl_days", 90))*24*3600,
+            max_entries=int(cache_config.get("max_entries", 5000)))
+
+    feed_state = FeedState(DiskCache(CACHE_DIR/"feed_state.sqlite3", table="feed_state", ttl=90*24*3600, max_entries=1000))
+
+    # RSSフィードの取得はarXivの検索と並行して行う
+    feed_config = config.get("feed_fetch", {})
+    feed_executor = ThreadPoolExecutor(max_workers=1)
+    feeds_future = feed_executor.submit(
+        fetch_and_parse_feeds, elsevier_rss_url + cambridge_rss_url,
+        max_concurrency=int(feed_config.get("max_concurrency", 8)),
+        per_host=int(feed_config.get("per_host", 2)),
+        interval=float(feed_config.get("interval", 0.5)),
+        timeout=float(feed_config.get("timeout", 20)),
+        state=feed_state)
+
+    driver = make_driver()
+    deepl_api_key = os.getenv("DEEPL_API_KEY") or args.deepl_api
+    translator = make_translator(config, translation_cache, deepl_api_key)
 
     day_before_yesterday = datetime.datetime.today() - datetime.timedelta(days=2)
-    day_before_yesterday_str = day_before_yesterday.strftime("%Y%m%d")
 
-    results = []
-    try:
-        arxiv_query = f"({subject}) AND " \
-                      f"submittedDate:" \
-                      f"[{day_before_yesterday_str}000000 TO {day_before_yesterday_str}235959]"
-        articles = arxiv.Search(query=arxiv_query,
-                               max_results=1000,
-                               sort_by = arxiv.SortCriterion.SubmittedDate).results()
-        articles = list(articles)
-        results_arxiv = search_keyword(driver, articles, keywords, score_threshold)
-        results.extend(results_arxiv)
-    except Exception as e:
-        print(e)
-    
-    try:
-        results_iop = parse_iop_rss(driver, iop_rss_url, keywords, score_threshold, ecs_info=[ecs_id, ecs_pass])
-        results.extend(results_iop)
-    except Exception as e:
-        print(e)
-        
-    try:
-        results_elsevier = parse_elsevier_rss(driver, elsevier_rss_url, keywords, score_threshold)
-        results.extend(results_elsevier)
-    except Exception as e:
-        print(e)
-        
-    try:
-        results_cambridge = parse_cambridge_rss(cambridge_rss_url, keywords, score_threshold)
-        results.extend(results_cambridge)
-    except Exception as e:
-        print(e)
+    openai_api = os.getenv("OPENAI_API") or args.openai_api
+    prefetcher = None
+    if openai_api is not None:
+        prefetcher = PdfPrefetcher(max_workers=int(config.get("pdf_prefetch_workers", 4)),
+                                   max_bytes=int(float(config.get("pdf_max_mb", 50))*1024*1024))
+
+    mirror_config = config.get("arxiv_mirror", {})
+    # 情報源をまたいで同じ論文をまとめる
+    dedup = DedupIndex(threshold=float(config.get("dedup_title_threshold", 0.8)))
+    arxiv_page_size = int(config.get("arxiv_page_size", 100))
+
+    def find_results():
+        try:
+            try:
+                if mirror_config.get("enabled", True):
+                    # 手元のミラーに足りない日だけAPIから取得し、キーワードを含む論文を索引で探す
+                    mirror = ArxivMirror(CACHE_DIR/"arxiv.sqlite3")
+                    try:
+                        mirror.prune(int(mirror_config.get("retention_days", 30)))
+                        mirror.harvest(subject, day_before_yesterday.date(), page_size=arxiv_page_size)
+                        articles = mirror.candidates(keywords, day_before_yesterday.date())
+                    finally:
+                        mirror.close()
+                else:
+                    # リストにはせず、ページごとに受け取りながらスコアを計算する
+                    articles = search_day(subject, day_before_yesterday.date(),
+                                          page_size=arxiv_page_size, max_results=1000)
+                yield from search_keyword(translator, articles, keywords, score_threshold, prefetcher, dedup)
+            except Exception as e:
+                print(e)
 
-    driver.quit()
+            try:
+                yield from parse_iop_rss(driver, translator, iop_rss_url, keywords, score_threshold, ecs_info=[ecs_id, ecs_pass], feed_state=feed_state, dedup=dedup)
+            except Exception as e:
+                print(e)
 
+            try:
+                feeds = feeds_future.result()
+            except Exception as e:
+                print(e)
+                feeds = None
+            feed_executor.shutdown()
+
+            try:
+                yield from parse_elsevier_rss(driver, translator, elsevier_rss_url, keywords, score_threshold, feeds, feed_state, dedup)
+            except Exception as e:
+                print(e)
+
+            try:
+                yield from parse_cambridge_rss(translator, cambridge_rss_url, keywords, score_threshold, feeds, feed_state, dedup)
+            except Exception as e:
+                print(e)
+        finally:
+            driver.quit()
+            translator.flush()
+
+    # 見つかった論文から順に翻訳・要約・通知する
+    results = iterate_in_background(find_results(), maxsize=int(config.get("queue_size", 16)))
     slack_token = os.getenv("SLACK_BOT_TOKEN") or args.slack_token
-    openai_api = os.getenv("OPENAI_API") or args.openai_api
-    notify(results, slack_token, openai_api)
+    notifier = None
+    if slack_token is not None:
+        notifier = SlackNotifier(slack_token, CHANNEL_ID, max_uploads=int(config.get("slack_uploads", 4)))
+    summarizer = None
+    summary_workers = int(config.get("summary_workers", 4))
+    if openai_api is not None:
+        summarizer = Summarizer(OpenAI(api_key=openai_api, max_retries=0), max_workers=summary_workers,
+                                max_retries=int(config.get("summary_max_retries", 5)), cache=summary_cache,
+                                batch_size=int(config.get("summary_batch_size", 1)))
+    slide_builder = None
+    marp_server = None
+    # 投稿中に例外が起きても、marpのサーバーやスレッド、キャッシュは必ず閉じる
+    try:
+        if summarizer is not None:
+            if config.get("marp_server", True):
+                marp_server = MarpServer(BASE_DIR)
+                try:
+                    marp_server.start()
+                except (OSError, RuntimeError) as e:
+                    print(f"Failed to start marp server: {e!r}")
+            slide_builder = SlideBuilder(max_processes=config.get("slide_processes"),
+                                         max_renders=int(config.get("slide_renders", 2)),
+                                         max_prepares=summary_workers, server=marp_server,
+                                         markdown_options={
+                                             "tables": config.get("slide_tables", False),
+                                             "table_cache_path": None if args.no_cache else CACHE_DIR/"tables.sqlite3",
+                                             "table_time_budget": float(config.get("table_time_budget", 10)),
+                                         })
+        if config.get("streaming", True):
+            notify_stream(results, translator, notifier, summarizer, slide_builder,
+                          final_ranking=config.get("final_ranking", True), window=2*summary_workers)
+        else:
+            result_list = list(results)
+            for result in result_list:
+                resolve_translation(result, translator)
+            notify(result_list, translator, notifier, summarizer, slide_builder)
+        # 通知まで終わったエントリだけを処理済みとして保存する
+        feed_state.commit()
+    finally:
+        # 検索のスレッドを止めて、閉じた後の翻訳器に論文が送られないようにする
+        results.close()
+        translator.close()
+        if summarizer is not None:
+            # まとめて要約する場合に溜まっている分を送る。送らないとスライドの準備が要約を待ち続ける
+            summarizer.flush()
+        if slide_builder is not None:
+            slide_builder.close()
+        if notifier is not None:
+            notifier.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        if marp_server is not None:
+            marp_server.close()
+        if summarizer is not None:
+            summarizer.close()
+        elif summary_cache is not None:
+            summary_cache.close()
+        if translation_cache is not None:
+            print(translation_cache.stats())
+            translation_cache.close()
+        feed_state.cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+import bisect
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import openai
+
+
+def parse_duration(text: str) -> float:
+    """x-ratelimit-reset-* の "6m0s", "1.5s", "20ms" などを秒に直す"""
+    if not text:
+        return 0.0
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(value) * units[unit] for value, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", text))
+
+
+class RateLimiter:
+    """
+    リクエスト数のトークンバケット
+    APIの x-ratelimit-* ヘッダーを見て補充の速さを合わせ、残りが無くなればリセットまで待つ。
+    """
+
+    def __init__(self, requests_per_minute: float = 500, burst: int = 4):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def block(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update(self, headers) -> None:
+        limit = headers.get("x-ratelimit-limit-requests")
+        if limit:
+            with self.lock:
+                self.rate = max(float(limit) / 60, 0.01)
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is not None and int(remaining) <= 0:
+                self.block(parse_duration(headers.get(f"x-ratelimit-reset-{kind}")))
+
+
+class LatencyHistogram:
+    BOUNDS = [0.5, 1, 2, 4, 8, 16, 32, 64]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.values = []
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            self.values.append(seconds)
+
+    def summary(self) -> str:
+        if not self.values:
+            return "no requests"
+        values = sorted(self.values)
+        p50 = values[len(values) // 2]
+        p90 = values[min(len(values) - 1, int(len(values) * 0.9))]
+        labels = [f"<{b}s" for b in self.BOUNDS] + [f">={self.BOUNDS[-1]}s"]
+        hist = ", ".join(f"{label}: {count}" for label, count in zip(labels, self.counts) if count)
+        return f"{len(values)} requests, p50 {p50:.1f} s, p90 {p90:.1f} s, max {values[-1]:.1f} s ({hist})"
+
+
+class Summarizer:
+    """
+    OpenAIのchat completionを並列に呼ぶ。
+    レート制限はRateLimiterで守り、429と5xxはジッター付きの指数バックオフで再試行する。
+    cacheには要約結果を保存する(使うのはget_summary)。
+    submit_batched()に渡したものはbatch_size件ずつまとめて1回のfnの呼び出しになる。
+    結果を待つ前にflush()を呼んで残りを送ること。
+    """
+
+    def __init__(self, client, model: str = "gpt-4o-mini", max_workers: int = 4, max_retries: int = 5,
+                 requests_per_minute: float = 500, cache=None, batch_size: int = 1):
+        self.client = client
+        self.model = model
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.max_retries = max_retries
+        self.limiter = RateLimiter(requests_per_minute, burst=max_workers)
+        self.latency = LatencyHistogram()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="summarizer")
+
+    def complete(self, messages: list, temperature: float = 0.25, **kwargs) -> str:
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(
+                    model=self.model, messages=messages, temperature=temperature, **kwargs)
+            except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+                if attempt == self.max_retries:
+                    raise
+                response = getattr(e, "response", None)
+                try:
+                    wait = float(response.headers.get("retry-after"))
+                except (AttributeError, TypeError, ValueError):
+                    wait = min(60, 2 ** attempt)
+                wait *= random.uniform(1, 1.5)
+                if response is not None:
+                    self.limiter.update(response.headers)
+                self.limiter.block(wait)
+                print(f"{type(e).__name__}: retry in {wait:.1f} s.")
+                continue
+            self.latency.add(time.monotonic() - start)
+            self.limiter.update(raw.headers)
+            return raw.parse().choices[0].message.content
+
+    def submit(self, fn, *args) -> Future:
+        return self.executor.submit(fn, *args)
+
+    def _run_batch(self, items: list) -> None:
+        fn = items[0][0]
+        try:
+            outputs = fn([item for _, item, _ in items])
+        except Exception as e:
+            outputs = [e] * len(items)
+        for (_, _, future), output in zip(items, outputs):
+            if isinstance(output, Exception):
+                future.set_exception(output)
+            else:
+                future.set_result(output)
+
+    def _dispatch(self) -> None:
+        items, self.pending = self.pending, []
+        if items:
+            self.executor.submit(self._run_batch, items)
+
+    def submit_batched(self, fn, item) -> Future:
+        """
+        fnは要素のリストを受け取り、同じ順番で結果か例外のリストを返す関数。
+        """
+        future = Future()
+        with self.lock:
+            self.pending.append((fn, item, future))
+            if len(self.pending) >= self.batch_size:
+                self._dispatch()
+        return future
+
+    def flush(self) -> None:
+        with self.lock:
+            self._dispatch()
+
+    def close(self) -> None:
+        self.flush()
+        self.executor.shutdown(wait=True)
+        print(f"Summary latency: {self.latency.summary()}")
+        if self.cache is not None:
+            print(self.cache.stats())
+            self.cache.close()
@@ -0,0 +1,154 @@
+import json
+import re
+
+# 要約の項目と、行形式で出力された場合の見出し
+SUMMARY_FIELDS = ("title_jp", "keywords", "problem", "method", "result")
+FIELD_LABELS = {
+    "title_jp": ("論文名", "タイトル", "題名"),
+    "keywords": ("キーワード",),
+    "problem": ("課題", "問題"),
+    "method": ("手法", "提案手法"),
+    "result": ("結果",),
+    "terminology": ("用語説明", "専門用語", "用語"),
+}
+LABEL_TO_FIELD = {label: field for field, labels in FIELD_LABELS.items() for label in labels}
+# 長い見出しから先に照合する ("提案手法"を"手法"より先に)
+LABEL_RE = re.compile(
+    r"^[\s\-*#>・]*(?:\d+[.)]\s*)?\**\s*("
+    + "|".join(sorted(map(re.escape, LABEL_TO_FIELD), key=len, reverse=True))
+    + r")\s*\**\s*(?:[:：]\s*\**\s*(.*))?$")
+JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def normalize_summary(data: dict) -> dict:
+    """
+    JSONで受け取った要約を項目名で引ける形にする。
+    キーが日本語の見出しでも受け付け、空の項目は無かったことにする。
+    """
+    summary_dict = {}
+    for key, value in data.items():
+        field = key if key in SUMMARY_FIELDS or key == "terminology" else LABEL_TO_FIELD.get(str(key).strip())
+        if field is None or value is None:
+            continue
+        if field == "terminology":
+            if isinstance(value, str):
+                value = value.split("\n")
+            elif isinstance(value, dict):
+                value = [f"{k}: {v}" for k, v in value.items()]
+            terms = [str(t).replace("`", "").strip() for t in value]
+            summary_dict["terminology"] = [t for t in terms if t]
+        else:
+            if isinstance(value, list):
+                value = ", ".join(map(str, value))
+            value = str(value).strip()
+            if value:
+                summary_dict[field] = value
+    return summary_dict
+
+
+def parse_json_summary(text: str):
+    """JSONとして読めればdictを返す。コードブロックや前後の文章が付いていても中身を探す。読めなければNone"""
+    for candidate in (text, *JSON_RE.findall(text or "")):
+        try:
+            data = json.loads(candidate)
+        except (TypeError, ValueError):
+            continue
+        if isinstance(data, dict):
+            return data
+    return None
+
+
+def parse_text_summary(text: str) -> dict:
+    """
+    "論文名: ..."のような行形式の要約を読む。
+    見出しの前の記号や太字、全角コロン、見出しと本文の改行を許す。
+    見出しの無い行は直前の項目の続きとし、結果の後の行は用語説明とみなす。
+    """
+    summary_dict = {}
+    current = None
+    for line in text.replace("\r\n", "\n").split("\n"):
+        m = LABEL_RE.match(line)
+        if m:
+            current = LABEL_TO_FIELD[m.group(1)]
+            if current in summary_dict:
+                continue
+            line = m.group(2) or ""
+        elif current == "result" and "result" in summary_dict:
+            current = "terminology"
+        if current is None or not line.strip():
+            continue
+        line = line.replace("`", "").strip()
+        if current == "terminology":
+            summary_dict.setdefault("terminology", []).append(line)
+        elif current in summary_dict:
+            summary_dict[current] += line
+        else:
+            summary_dict[current] = line.strip("*").strip()
+    return summary_dict
+
+
+def parse_summary(text: str) -> dict:
+    data = parse_json_summary(text)
+    if data is not None:
+        summary_dict = normalize_summary(data)
+        if summary_dict:
+            return summary_dict
+    return normalize_summary(parse_text_summary(text or ""))
+
+
+def missing_fields(summary_dict: dict) -> list:
+    return [field for field in SUMMARY_FIELDS if not summary_dict.get(field)]
+
+
+def fill_missing(summary_dict: dict) -> dict:
+    """聞き直しても埋まらなかった項目を空にして、スライド作成でKeyErrorにならないようにする"""
+    for field in missing_fields(summary_dict):
+        summary_dict[field] = ""
+    summary_dict.setdefault("terminology", [])
+    return summary_dict
+
+
+# 壊れた出力の例。python summary_parser.py で全て読めることを確かめる
+MALFORMED_COMPLETIONS = [
+    # 行形式
+    ("論文名:量子ドットの光学特性\nキーワード:量子ドット\n課題:発光効率が低い\n手法:表面修飾\n結果:効率が2倍\n量子ドット(quantum dot): 小さな半導体の粒",
+     SUMMARY_FIELDS, 1),
+    # 全角コロン、太字、箇条書き
+    ("**論文名**：量子ドット\n- **キーワード**：QD\n- 課題： 低効率\n- 手法：修飾\n- 結果：改善\n\n用語説明：\n- QD: 量子ドット",
+     SUMMARY_FIELDS, 1),
+    # 見出しと本文が別の行
+    ("論文名\n量子ドット\nキーワード\nQD\n課題\n低効率\n手法\n修飾\n結果\n改善", SUMMARY_FIELDS, 0),
+    # 見出しで始まる用語説明
+    ("論文名: A\nキーワード: B\n課題: C\n手法: D\n結果: E\n結果整合性(eventual consistency): いずれ揃うこと", SUMMARY_FIELDS, 1),
+    # 番号付き、"提案手法"
+    ("1. 論文名: A\n2. キーワード: B\n3. 課題: C\n4. 提案手法: D\n5. 結果: E", SUMMARY_FIELDS, 0),
+    # JSON
+    ('{"title_jp": "A", "keywords": ["B", "C"], "problem": "D", "method": "E", "result": "F", "terminology": "x: y\\nz: w"}',
+     SUMMARY_FIELDS, 2),
+    # コードブロックに入ったJSON
+    ('以下が要約です。\n```json\n{"title_jp": "A", "keywords": "B", "problem": "C", "method": "D", "result": "E", "terminology": []}\n```',
+     SUMMARY_FIELDS, 0),
+    # 日本語のキーのJSON
+    ('{"論文名": "A", "キーワード": "B", "課題": "C", "手法": "D", "結果": "E", "用語説明": {"x": "y"}}', SUMMARY_FIELDS, 1),
+    # 項目の欠けたJSON
+    ('{"title_jp": "A", "keywords": "", "problem": "C", "result": "E"}', ("title_jp", "problem", "result"), 0),
+    # 途中で切れたJSON
+    ('{"title_jp": "A", "keywords": "B", "pro', (), 0),
+    # 空
+    ("", (), 0),
+]
+
+
+def check() -> None:
+    for text, fields, n_terms in MALFORMED_COMPLETIONS:
+        summary_dict = parse_summary(text)
+        missing = missing_fields(summary_dict)
+        assert set(SUMMARY_FIELDS) - set(missing) == set(fields), (text, summary_dict)
+        assert len(summary_dict.get("terminology", [])) == n_terms, (text, summary_dict)
+        summary_dict = fill_missing(summary_dict)
+        assert not any(field not in summary_dict for field in SUMMARY_FIELDS)
+    print(f"{len(MALFORMED_COMPLETIONS)} completions parsed.")
+
+
+if __name__ == "__main__":
+    check()
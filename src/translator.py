@@ -0,0 +1,245 @@
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from cache import text_hash
+from requests.adapters import HTTPAdapter
+from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.firefox.service import Service
+from selenium.webdriver.support.ui import WebDriverWait
+from urllib3.util.retry import Retry
+from webdriver_manager.firefox import GeckoDriverManager
+
+DEEPL_URL = "https://www.deepl.com/translator"
+DEEPL_API_URL = "https://api-free.deepl.com/v2/translate"
+RESULT_XPATH = '//*[@id="textareasContainer"]/div[3]/section/div[1]/d-textarea/div'
+
+
+def make_driver():
+    options = webdriver.FirefoxOptions()
+    options.add_argument("-headless")
+    firefox_profile = webdriver.firefox.firefox_profile.FirefoxProfile()
+    firefox_profile.set_preference("browser.privatebrowsing.autostart", True)
+    options.profile = firefox_profile
+    driver = webdriver.Firefox(service=Service(GeckoDriverManager().install()), options=options)
+    driver.implicitly_wait(10)
+    driver.set_page_load_timeout(10)
+    return driver
+
+
+def get_text_from_driver(driver) -> str:
+    try:
+        elem = driver.find_element(by=By.XPATH, value=RESULT_XPATH)
+    except NoSuchElementException as e:
+        return None
+    text = elem.get_attribute("textContent")
+    return text
+
+
+class translation_settled:
+    """
+    WebDriverWait用の条件。訳文が空でなく、stable_for秒変化しなくなったら訳文を返す。
+    DeepLは訳文を少しずつ書き換えるので、最初に現れた文字列では途中までしか取れないことがある。
+    同じブラウザで続けて翻訳するとURLのフラグメントが変わるだけで前の訳文が残っているので、
+    previous(前の訳文)と同じ文字列は訳文とみなさない。
+    """
+
+    def __init__(self, stable_for: float = 0.5, previous: str = None):
+        self.stable_for = stable_for
+        self.previous = previous
+        self.last_text = None
+        self.last_changed = None
+
+    def __call__(self, driver):
+        text = get_text_from_driver(driver)
+        now = time.monotonic()
+        if not text or not text.strip() or text == self.previous:
+            self.last_text = None
+            return False
+        if text != self.last_text:
+            self.last_text = text
+            self.last_changed = now
+            return False
+        if now - self.last_changed >= self.stable_for:
+            return text
+        return False
+
+
+def get_translated_text(from_lang: str, to_lang: str, from_text: str, driver, cache=None, base_url: str = DEEPL_URL, timeout: float = 30) -> str:
+    if cache is not None:
+        key = text_hash(from_lang, to_lang, from_text)
+        if (cached := cache.get(key)) is not None:
+            return cached
+
+    start = time.monotonic()
+    quoted_text = urllib.parse.quote(from_text)
+    url = base_url + "#" \
+        + from_lang + "/" + to_lang + "/" + quoted_text
+
+    # 暗黙の待機があると要素が無い間のポーリングが止まるので、明示的な待機だけにする
+    driver.implicitly_wait(0)
+    driver.set_page_load_timeout(timeout)
+    try:
+        previous = get_text_from_driver(driver)
+        driver.get(url)
+        wait = WebDriverWait(driver, max(0, timeout - (time.monotonic() - start)), poll_frequency=0.1,
+                             ignored_exceptions=[StaleElementReferenceException])
+        to_text = wait.until(translation_settled(previous=previous))
+    except TimeoutException:
+        print(f"Translation timed out after {time.monotonic() - start:.1f} s.")
+        return from_text
+    print(f"Translated {len(from_text)} chars in {time.monotonic() - start:.1f} s.")
+
+    if cache is not None:
+        cache.set(key, to_text)
+    return to_text
+
+
+class Translator:
+    """
+    翻訳バックエンドの共通部分
+    submit()はFutureを返す。キャッシュにあるものは即座に完了し、それ以外はbatch_size件ずつ
+    まとめてtranslate_batch()に渡される。結果を待つ前にflush()を呼んで残りを送ること。
+    """
+
+    def __init__(self, n_workers: int = 1, cache=None, batch_size: int = 1):
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, n_workers), thread_name_prefix="translator")
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def translate_batch(self, from_lang: str, to_lang: str, texts: list) -> list:
+        raise NotImplementedError
+
+    def _run(self, from_lang: str, to_lang: str, items: list) -> None:
+        try:
+            to_texts = self.translate_batch(from_lang, to_lang, [text for text, _ in items])
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+        for (from_text, future), to_text in zip(items, to_texts):
+            # 翻訳に失敗すると原文が返ってくるので、キャッシュしない
+            if self.cache is not None and to_text != from_text:
+                self.cache.set(text_hash(from_lang, to_lang, from_text), to_text)
+            future.set_result(to_text)
+
+    def _dispatch(self, key) -> None:
+        items = self.pending.pop(key, [])
+        if items:
+            self.executor.submit(self._run, *key, items)
+
+    def submit(self, from_lang: str, to_lang: str, from_text: str) -> Future:
+        future = Future()
+        if self.cache is not None:
+            cached = self.cache.get(text_hash(from_lang, to_lang, from_text))
+            if cached is not None:
+                future.set_result(cached)
+                return future
+        key = (from_lang, to_lang)
+        with self.lock:
+            self.pending.setdefault(key, []).append((from_text, future))
+            if len(self.pending[key]) >= self.batch_size:
+                self._dispatch(key)
+        return future
+
+    def flush(self) -> None:
+        with self.lock:
+            for key in list(self.pending):
+                self._dispatch(key)
+
+    def close(self) -> None:
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+
+class SeleniumTranslator(Translator):
+    """
+    DeepLのWebページをn_workers個のヘッドレスブラウザで並列に操作して翻訳する。
+    base_urlをローカルのスタブサーバーに向ければオフラインで動作確認できる。
+    """
+
+    def __init__(self, n_workers: int = 1, cache=None, driver_factory=make_driver, base_url: str = DEEPL_URL, timeout: float = 30):
+        super().__init__(n_workers, cache)
+        self.driver_factory = driver_factory
+        self.base_url = base_url
+        self.timeout = timeout
+        self.local = threading.local()
+        self.drivers = []
+
+    def _driver(self):
+        driver = getattr(self.local, "driver", None)
+        if driver is None:
+            driver = self.driver_factory()
+            self.local.driver = driver
+            with self.lock:
+                self.drivers.append(driver)
+        return driver
+
+    def translate_batch(self, from_lang: str, to_lang: str, texts: list) -> list:
+        driver = self._driver()
+        return [get_translated_text(from_lang, to_lang, text, driver, base_url=self.base_url, timeout=self.timeout) for text in texts]
+
+    def close(self) -> None:
+        super().close()
+        for driver in self.drivers:
+            driver.quit()
+        self.drivers = []
+
+
+class DeepLApiTranslator(Translator):
+    """
+    DeepL API (https://developers.deepl.com/docs/api-reference/translate) で翻訳する。
+    1回のリクエストで最大50件まとめて送り、コネクションはrequests.Sessionで使い回す。
+    """
+
+    def __init__(self, auth_key: str, n_workers: int = 1, cache=None, batch_size: int = 50, url: str = DEEPL_API_URL, timeout: float = 30):
+        super().__init__(n_workers, cache, min(batch_size, 50))
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=max(1, n_workers), max_retries=Retry(
+            total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])))
+        self.session.headers["Authorization"] = f"DeepL-Auth-Key {auth_key}"
+
+    def translate_batch(self, from_lang: str, to_lang: str, texts: list) -> list:
+        start = time.monotonic()
+        response = self.session.post(self.url, json={
+            "text": texts,
+            "source_lang": from_lang.upper(),
+            "target_lang": to_lang.upper(),
+        }, timeout=self.timeout)
+        response.raise_for_status()
+        print(f"Translated {len(texts)} texts in {time.monotonic() - start:.1f} s.")
+        return [t["text"] for t in response.json()["translations"]]
+
+    def close(self) -> None:
+        super().close()
+        self.session.close()
+
+
+class EchoTranslator(Translator):
+    """原文をそのまま返す。テストやオフラインでの動作確認用"""
+
+    def translate_batch(self, from_lang: str, to_lang: str, texts: list) -> list:
+        return list(texts)
+
+
+def make_translator(config: dict, cache=None, deepl_api_key: str = None) -> Translator:
+    backend = config.get("translator", "selenium")
+    n_workers = int(config.get("translation_workers", 1))
+    timeout = float(config.get("translation_timeout", 30))
+    if backend == "deepl_api":
+        if deepl_api_key is not None:
+            return DeepLApiTranslator(deepl_api_key, n_workers, cache,
+                                      batch_size=int(config.get("translation_batch_size", 50)),
+                                      url=config.get("deepl_api_url", DEEPL_API_URL), timeout=timeout)
+        print("DeepL API key is not set. Fall back to selenium.")
+    elif backend == "echo":
+        return EchoTranslator(n_workers, cache)
+    return SeleniumTranslator(n_workers, cache, timeout=timeout)
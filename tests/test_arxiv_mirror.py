@@ -0,0 +1,131 @@
+import datetime
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+import arxiv
+import pytest
+
+from arxiv_mirror import ArxivMirror, search_day
+
+FEED_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" xmlns:arxiv="http://arxiv.org/schemas/atom">
+  <opensearch:totalResults>{total}</opensearch:totalResults>
+"""
+
+ENTRIES = [
+    """<entry>
+    <id>http://arxiv.org/abs/2401.00001v1</id>
+    <updated>2024-01-05T10:00:00Z</updated><published>2024-01-05T10:00:00Z</published>
+    <title>Resistive wall mode control in JT-60SA</title>
+    <summary>We study the resistive wall mode in a tokamak plasma.</summary>
+    <author><name>A. Author</name></author><author><name>B. Author</name></author>
+    <arxiv:primary_category term="physics.plasm-ph"/><category term="physics.plasm-ph"/>
+    <link href="http://arxiv.org/abs/2401.00001v1" rel="alternate" type="text/html"/>
+    <link title="pdf" href="http://arxiv.org/pdf/2401.00001v1" rel="related" type="application/pdf"/>
+  </entry>""",
+    """<entry>
+    <id>http://arxiv.org/abs/2401.00002v1</id>
+    <updated>2024-01-05T11:00:00Z</updated><published>2024-01-05T11:00:00Z</published>
+    <title>Graph neural networks for chemistry</title>
+    <summary>Nothing about fusion.</summary>
+    <author><name>C. Author</name></author>
+    <arxiv:primary_category term="cs.LG"/><category term="cs.LG"/>
+    <link href="http://arxiv.org/abs/2401.00002v1" rel="alternate" type="text/html"/>
+  </entry>""",
+    # 1件目の改訂版。同じ論文として1行にまとまる
+    """<entry>
+    <id>http://arxiv.org/abs/2401.00001v2</id>
+    <updated>2024-01-06T10:00:00Z</updated><published>2024-01-05T10:00:00Z</published>
+    <title>Resistive wall mode control in JT-60SA (revised)</title>
+    <summary>We study the resistive wall mode (RWM) in a tokamak plasma. Revised.</summary>
+    <author><name>A. Author</name></author>
+    <arxiv:primary_category term="physics.plasm-ph"/><category term="physics.plasm-ph"/>
+    <link href="http://arxiv.org/abs/2401.00001v2" rel="alternate" type="text/html"/>
+  </entry>""",
+]
+
+DAY = datetime.date(2024, 1, 5)
+QUERY = "cat:physics.plasm-ph"
+
+
+def make_stub_arxiv(entries: list):
+    """arXiv APIの代わりに、entriesをstartとmax_resultsで切り出して返す。受けたクエリはhandler.queriesに残る"""
+
+    class StubArxiv(BaseHTTPRequestHandler):
+        queries = []
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            self.queries.append(query)
+            start, size = int(query["start"][0]), int(query["max_results"][0])
+            body = (FEED_HEADER.format(total=len(entries)) + "".join(entries[start:start + size]) + "</feed>").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/atom+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StubArxiv
+
+
+@pytest.fixture
+def stub_arxiv(http_server, monkeypatch):
+    def start(entries: list):
+        handler = make_stub_arxiv(entries)
+        monkeypatch.setattr(arxiv.Client, "query_url_format", http_server(handler) + "/api/query?{}")
+        return handler
+
+    return start
+
+
+def test_harvest_pages_through_search_day(stub_arxiv):
+    handler = stub_arxiv(ENTRIES)
+    mirror = ArxivMirror()
+    assert mirror.harvest(QUERY, DAY, page_size=2) == 3
+    assert [query["start"] for query in handler.queries] == [["0"], ["2"]]
+    assert "submittedDate:[20240105000000 TO 20240105235959]" in handler.queries[0]["search_query"][0]
+    assert mirror.is_harvested(QUERY, DAY)
+    # 取得済みの日はAPIを呼ばない
+    assert mirror.harvest(QUERY, DAY) == 0
+    assert len(handler.queries) == 2
+
+    papers = mirror.candidates(["resistive wall mode", "RWM"], DAY)
+    assert [paper.get_short_id() for paper in papers] == ["2401.00001v2"]
+    assert papers[0].authors == "A. Author"
+    mirror.close()
+
+
+def test_empty_first_page_is_not_marked_harvested(stub_arxiv):
+    handler = stub_arxiv([])
+    mirror = ArxivMirror()
+    assert mirror.harvest(QUERY, DAY) == 0
+    assert not mirror.is_harvested(QUERY, DAY)
+    # 次回はもう一度APIを呼ぶ
+    mirror.harvest(QUERY, DAY)
+    assert len(handler.queries) == 2
+    mirror.close()
+
+
+def test_search_day_with_limit(stub_arxiv):
+    stub_arxiv(ENTRIES)
+    results = list(search_day(QUERY, DAY, page_size=100, max_results=1000))
+    assert [result.get_short_id() for result in results] == ["2401.00001v1", "2401.00002v1", "2401.00001v2"]
+
+
+def test_export_and_load(stub_arxiv, tmp_path):
+    stub_arxiv(ENTRIES)
+    mirror = ArxivMirror(tmp_path / "arxiv.sqlite3")
+    mirror.harvest(QUERY, DAY)
+    mirror.export(tmp_path / "dump.jsonl", DAY)
+    mirror.close()
+
+    offline = ArxivMirror()
+    assert offline.load(tmp_path / "dump.jsonl") == 2
+    # 2文字のキーワードは索引を使わずに探す
+    assert [paper.title for paper in offline.candidates(["fu"], DAY)] == ["Graph neural networks for chemistry"]
+    offline.prune(0)
+    assert offline.candidates(["tokamak"], DAY) == []
+    offline.close()
@@ -0,0 +1,74 @@
+import datetime
+
+import pytest
+
+from arxiv_mirror import ArxivPaper
+from dedup_index import DedupIndex, normalize_doi, title_markers
+from slide_owl import Result, merge_duplicate
+
+RWM_TITLE = "Resistive wall mode stabilization in JT-60SA with $\\beta_N$ feedback"
+
+
+@pytest.fixture
+def index():
+    index = DedupIndex()
+    index.add("arxiv", None, RWM_TITLE, source="arxiv")
+    index.add("other", "10.1088/1741-4326/ad0001", "Turbulent transport in stellarators")
+    return index
+
+
+def test_normalize_doi():
+    assert normalize_doi("https://doi.org/10.1088/ABC") == "10.1088/abc"
+    assert normalize_doi("doi: 10.1088/abc") == "10.1088/abc"
+    assert normalize_doi("not a doi") == ""
+    assert normalize_doi(None) == ""
+
+
+def test_matches_by_doi_and_similar_title(index):
+    assert index.find("https://doi.org/10.1088/1741-4326/AD0001", "x") == "other"
+    assert index.find(None, "Resistive Wall Mode Stabilization in JT-60SA with β<sub>N</sub> Feedback", "iop") == "arxiv"
+    assert index.find("10.1016/j.fusengdes.2024.1",
+                      "Resistive wall mode stabilisation in JT-60SA with beta_N feedback", "elsevier") == "arxiv"
+    assert index.find(None, "Resistive wall mode in ITER") is None
+    assert index.find(None, "Editorial") is None
+
+
+def test_same_source_and_different_arxiv_ids_are_not_merged(index):
+    assert index.find(None, RWM_TITLE, source="arxiv") is None
+    index.add("2401.00001", None, "Sawtooth crash simulation in tokamak plasmas", source="arxiv", arxiv_id="2401.00001")
+    assert index.find(None, "Sawtooth crash simulation in tokamak plasmas", source="iop") == "2401.00001"
+    assert index.find(None, "Sawtooth crash simulation in tokamak plasmas", arxiv_id="2401.00002") is None
+
+
+@pytest.mark.parametrize("title, other, same", [
+    ("Nonlinear MHD simulation of ELMs in ASDEX Upgrade. Part I: Linear phase",
+     "Nonlinear MHD simulation of ELMs in ASDEX Upgrade. Part II: Nonlinear phase", False),
+    ("Nonlinear MHD simulation of ELMs in ASDEX Upgrade. Part I: Linear phase",
+     "Nonlinear MHD simulation of ELMs in ASDEX Upgrade, Part 1: Linear phase", True),
+    ("Turbulence spreading in the edge of the Wendelstein 7-X stellarator",
+     "Erratum: Turbulence spreading in the edge of the Wendelstein 7-X stellarator", False),
+    ("Gyrokinetic simulations of ion temperature gradient modes II",
+     "Gyrokinetic simulations of ion temperature gradient modes III", False),
+    ("Gyrokinetic simulations of ion temperature gradient modes II",
+     "Gyrokinetic simulations of ion temperature gradient modes 2", True),
+])
+def test_part_numbers_and_notices(title, other, same):
+    index = DedupIndex()
+    index.add("first", None, title, source="arxiv")
+    assert (index.find(None, other, source="iop") == "first") == same
+    assert (title_markers(title) == title_markers(other)) == same
+
+
+def test_merge_duplicate_keeps_higher_score_and_links():
+    day = datetime.datetime(2024, 1, 5, tzinfo=datetime.timezone.utc)
+    index = DedupIndex()
+    preprint = Result(score=10, hit_keywords=["tokamak"], source="arxiv", res=ArxivPaper(
+        "http://arxiv.org/abs/2401.00001v1", "Resistive wall mode control\n  in JT-60SA", "s", "A", day, day))
+    journal = Result(score=15, hit_keywords=["tokamak", "VMEC"], source="iop", res={
+        "title": "Resistive Wall Mode Control in JT-60SA", "link": "https://iop.example/x", "prism_doi": "10.1088/x"})
+    by_doi = Result(score=5, hit_keywords=["plasma"], source="elsevier", res={
+        "title": "Another title", "link": "https://elsevier.example/y", "doi": "https://doi.org/10.1088/X"})
+    assert [merge_duplicate(result, index) for result in (preprint, journal, by_doi)] == [False, True, True]
+    assert preprint.score == 15
+    assert preprint.hit_keywords == ["tokamak", "VMEC", "plasma"]
+    assert preprint.links == [("iop", "https://iop.example/x"), ("elsevier", "https://elsevier.example/y")]
@@ -0,0 +1,119 @@
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+from cache import DiskCache
+from feed_fetcher import FeedState, fetch_and_parse_feeds
+
+
+def make_feed(n_entries: int) -> bytes:
+    items = "".join(f"<item><title>Paper {i}</title><link>https://example.org/paper{i}</link>"
+                    f"<guid>paper{i}</guid><description>Abstract {i}</description></item>"
+                    for i in range(n_entries))
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Stub</title>'
+            f"{items}</channel></rss>").encode()
+
+
+FEED = make_feed(3)
+ETAG = '"stub-etag"'
+
+
+def make_stub_feeds(delay: float = 0.1, slow: float = 1.0):
+    """
+    用意したフィードを返すサーバー。/slow.xmlはslow秒待ってから返す。
+    ETagが一致すれば304を返す。受けたリクエストは(パス, ホスト, 開始時刻)としてhandler.requestsに、
+    ホストごとの同時接続数の最大はhandler.max_activeに残る。
+    """
+
+    class StubFeeds(BaseHTTPRequestHandler):
+        requests = []
+        active = {}
+        max_active = {}
+        lock = threading.Lock()
+
+        def do_GET(self):
+            host = self.headers["Host"].split(":")[0]
+            path = urllib.parse.urlsplit(self.path).path
+            with self.lock:
+                # 応答を返した後に記録すると、クライアントが先に終わることがある
+                self.requests.append((path, host, time.monotonic()))
+                self.active[host] = self.active.get(host, 0) + 1
+                self.max_active[host] = max(self.max_active.get(host, 0), self.active[host])
+            try:
+                time.sleep(slow if path == "/slow.xml" else delay)
+                if self.headers.get("If-None-Match") == ETAG:
+                    self.send_response(304)
+                    self.send_header("ETag", ETAG)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/rss+xml")
+                self.send_header("ETag", ETAG)
+                self.send_header("Content-Length", str(len(FEED)))
+                self.end_headers()
+                self.wfile.write(FEED)
+            finally:
+                with self.lock:
+                    self.active[host] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    return StubFeeds
+
+
+def test_parallel_fetch_respects_per_host_limit(http_server):
+    handler = make_stub_feeds(delay=0.2)
+    url = http_server(handler)
+    port = url.rsplit(":", 1)[1]
+    # 127.0.0.1とlocalhostは別のホストとして数える
+    urls = [f"http://127.0.0.1:{port}/feed{i}.xml" for i in range(4)] + \
+           [f"http://localhost:{port}/feed{i}.xml" for i in range(4)]
+    start = time.monotonic()
+    feeds = fetch_and_parse_feeds(urls, max_concurrency=8, per_host=2, interval=0.05, timeout=5)
+    elapsed = time.monotonic() - start
+
+    assert all(len(feeds[url]["entries"]) == 3 for url in urls)
+    assert len(handler.requests) == 8
+    # 2つのホストに2本ずつ、4件ずつを2回に分けて取得する
+    assert elapsed < 8 * 0.2 * 0.75, elapsed
+    assert handler.max_active == {"127.0.0.1": 2, "localhost": 2}
+    for host in ("127.0.0.1", "localhost"):
+        starts = sorted(start for _, h, start in handler.requests if h == host)
+        assert all(b - a >= 0.04 for a, b in zip(starts, starts[1:])), starts
+
+
+def test_timeout_gives_none_without_blocking_others(http_server):
+    url = http_server(make_stub_feeds(delay=0.05, slow=2.0))
+    feeds = fetch_and_parse_feeds([f"{url}/slow.xml", f"{url}/feed.xml"], timeout=0.5, interval=0)
+    assert feeds[f"{url}/slow.xml"] is None
+    assert len(feeds[f"{url}/feed.xml"]["entries"]) == 3
+
+
+def test_not_modified_feed_is_skipped_when_all_entries_are_seen(http_server, tmp_path):
+    handler = make_stub_feeds(delay=0)
+    url = f"{http_server(handler)}/feed.xml"
+    cache = DiskCache(tmp_path / "feed_state.sqlite3", table="feed_state")
+
+    state = FeedState(cache)
+    d = fetch_and_parse_feeds([url], state=state, interval=0)[url]
+    assert len(d["entries"]) == 3
+    for entry in d["entries"][:2]:
+        state.mark_seen(url, entry)
+    state.commit()
+
+    # 304で前回の本文を使い、処理済みのエントリを除く
+    state = FeedState(cache)
+    assert state.headers(url) == {"If-None-Match": ETAG}
+    d = fetch_and_parse_feeds([url], state=state, interval=0)[url]
+    assert [entry["title"] for entry in d["entries"]] == ["Paper 2"]
+    state.mark_seen(url, d["entries"][0])
+    state.commit()
+
+    # 全て処理済みならパースもせずNoneになる
+    state = FeedState(cache)
+    assert fetch_and_parse_feeds([url], state=state, interval=0)[url] is None
+    assert state.all_seen(url)
+    assert [path for path, *_ in handler.requests] == ["/feed.xml"] * 3
+    cache.close()
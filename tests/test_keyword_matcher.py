@@ -0,0 +1,16 @@
+from keyword_matcher import KeywordMatcher
+from slide_owl import calc_score
+
+KEYWORDS = {"tokamak": 5, "VMEC": 3, "Resistive wall mode": 2}
+
+
+def test_calc_score_with_matcher():
+    matcher = KeywordMatcher(KEYWORDS)
+    # 全て大文字のキーワードだけ大文字小文字を区別し、ヒットはconfig.yamlの順に並ぶ
+    assert calc_score("Resistive Wall Mode in a TOKAMAK computed with VMEC", matcher) == (10.0, list(KEYWORDS))
+    assert calc_score("the vmec equilibrium of a tokamak", matcher) == (5.0, ["tokamak"])
+
+
+def test_case_insensitive_matcher():
+    matcher = KeywordMatcher(KEYWORDS, case_sensitive_upper=False)
+    assert matcher("the vmec equilibrium") == (3.0, ["VMEC"])
@@ -0,0 +1,82 @@
+import fitz
+import pytest
+
+from make_slide import PdfDocument
+
+
+def make_pdf(path, n_pages: int = 6, table_pages=()):
+    """1ページに1枚、縮小では弾かれない大きさのノイズ画像を置いたPDF。table_pagesには表のキャプションを書く"""
+    doc = fitz.open()
+    for pno in range(n_pages):
+        page = doc.new_page()
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 300, 300), False)
+        pix.set_rect(pix.irect, (pno * 40 % 256, 80, 160))
+        for x in range(0, 300, 7):
+            for y in range(0, 300, 5):
+                pix.set_pixel(x, y, ((x * y + pno) % 256, (x + pno) % 256, y % 256))
+        page.insert_image(fitz.Rect(50, 50, 350, 350), pixmap=pix)
+        page.insert_text((50, 400), f"Table {pno + 1}" if pno in table_pages else f"Page {pno + 1}")
+    doc.save(path)
+    doc.close()
+    return path
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    """PdfDocumentがページの本文を取り出した回数と、画像を調べたページ"""
+    calls = {"get_text": 0, "image_pages": []}
+    get_text = fitz.Page.get_text
+    extract_images = PdfDocument._extract_images
+
+    def counting_get_text(self, *args, **kwargs):
+        calls["get_text"] += 1
+        return get_text(self, *args, **kwargs)
+
+    def counting_extract_images(self, page, *args, **kwargs):
+        calls["image_pages"].append(page.number)
+        return extract_images(self, page, *args, **kwargs)
+
+    monkeypatch.setattr(fitz.Page, "get_text", counting_get_text)
+    monkeypatch.setattr(PdfDocument, "_extract_images", counting_extract_images)
+    return calls
+
+
+def test_images_only_stop_at_max_images_without_text(tmp_path, counted):
+    pdf_path = make_pdf(tmp_path / "paper.pdf")
+    with PdfDocument(pdf_path) as pdf:
+        pdf.analyze(tmp_path / "img", max_images=2, abssize=0)
+    assert len(pdf.images) == 2
+    assert counted["image_pages"] == [0, 1]
+    assert counted["get_text"] == 0
+    assert pdf.texts == []
+
+
+def test_texts_are_kept_only_when_requested(tmp_path, counted):
+    pdf_path = make_pdf(tmp_path / "paper.pdf", n_pages=3)
+    with PdfDocument(pdf_path) as pdf:
+        pdf.analyze(tmp_path / "img", max_images=1, abssize=0, texts=True)
+    assert counted["image_pages"] == [0]
+    assert [text.strip() for text in pdf.texts] == ["Page 1", "Page 2", "Page 3"]
+
+
+class DictCache(dict):
+    def set(self, key, value):
+        self[key] = value
+
+
+def test_tables_are_cached_only_when_not_cut_short(tmp_path, monkeypatch):
+    pdf_path = make_pdf(tmp_path / "paper.pdf", n_pages=4, table_pages=(0, 2))
+    pages = []
+    monkeypatch.setattr(PdfDocument, "_extract_tables", lambda self, page, max_num: pages.append(page.number))
+
+    cache = DictCache()
+    with PdfDocument(pdf_path) as pdf:
+        pdf.analyze(tables=True, table_cache=cache, table_time_budget=0)
+    # 1ページ目を調べた時点で時間切れになり、途中までの表は保存しない
+    assert pages == [0]
+    assert cache == {}
+
+    with PdfDocument(pdf_path) as pdf:
+        pdf.analyze(tables=True, table_cache=cache)
+    assert pages == [0, 0, 2]
+    assert list(cache) == [pdf.hash]
@@ -0,0 +1,141 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import pytest
+
+from slack_notifier import SlackNotifier
+
+
+def make_mock_slack():
+    """
+    Slack APIのモック。chat.postMessage / chat.update / files.getUploadURLExternal /
+    files.completeUploadExternal とアップロード先のURLに答え、呼ばれた順にhandler.logに記録する。
+    アップロードは各ファイルの1回目だけ429を返し、thread_tsが"missing"の投稿はthread_not_foundで失敗させる。
+    """
+
+    class MockSlack(BaseHTTPRequestHandler):
+        log = []
+        uploads = {}
+        throttled = set()
+        lock = threading.Lock()
+
+        def reply(self, status: int, body: bytes = b"", headers: dict = None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.startswith("/upload/"):
+                file_id = self.path.split("/")[-1]
+                with self.lock:
+                    throttle = file_id not in self.throttled
+                    self.throttled.add(file_id)
+                if throttle:
+                    self.reply(429, headers={"Retry-After": "0.1"})
+                    return
+                self.uploads[file_id] = len(body)
+                self.reply(200, b"OK")
+                return
+            try:
+                args = json.loads(body)
+            except ValueError:
+                args = {key: value[0] for key, value in parse_qs(body.decode()).items()}
+            method = self.path.rstrip("/").split("/")[-1]
+            with self.lock:
+                if args.get("thread_ts") == "missing":
+                    response = {"ok": False, "error": "thread_not_found"}
+                elif method == "chat.postMessage":
+                    self.log.append(("post", args.get("thread_ts"), args["text"]))
+                    response = {"ok": True, "ts": f"{len(self.log)}.000"}
+                elif method == "chat.update":
+                    self.log.append(("update", args["ts"], args["text"]))
+                    response = {"ok": True}
+                elif method == "files.getUploadURLExternal":
+                    file_id = "F_" + args["filename"]
+                    response = {"ok": True, "file_id": file_id,
+                                "upload_url": f"http://{self.headers['Host']}/upload/{file_id}"}
+                elif method == "files.completeUploadExternal":
+                    files = json.loads(args["files"]) if isinstance(args["files"], str) else args["files"]
+                    self.log.append(("share", args.get("thread_ts"), files[0]["id"]))
+                    response = {"ok": True}
+                else:
+                    response = {"ok": False, "error": "unknown_method"}
+            self.reply(200, json.dumps(response).encode(), {"Content-Type": "application/json"})
+
+        def log_message(self, *args):
+            pass
+
+    return MockSlack
+
+
+@pytest.fixture
+def slack(http_server):
+    handler = make_mock_slack()
+    notifier = SlackNotifier("xoxb-test", "C_TEST", base_url=f"{http_server(handler)}/api/")
+    yield handler, notifier
+    notifier.close()
+
+
+def write_slides(tmp_path, n: int) -> list:
+    paths = [tmp_path / f"slide{i}.pdf" for i in range(n)]
+    for i, path in enumerate(paths):
+        path.write_bytes(b"%PDF" + b"x" * 1000 * (i + 1))
+    return paths
+
+
+def test_shares_in_submission_order(slack, tmp_path):
+    handler, notifier = slack
+    paths = write_slides(tmp_path, 5)
+    slides = [Future() for _ in paths]
+
+    def finish():
+        # スライドはばらばらの順番で出来上がる。3番目は作成に失敗する
+        for i in random.Random(0).sample(range(5), 5):
+            time.sleep(0.02)
+            if i == 3:
+                slides[i].set_exception(RuntimeError("marp failed"))
+            else:
+                slides[i].set_result(paths[i])
+
+    ts = notifier.post("header")
+    threading.Thread(target=finish).start()
+    uploads = [notifier.upload(slide) for slide in slides]
+    for i, upload in enumerate(uploads):
+        try:
+            notifier.share(upload.result(), f"paper{i}", ts)
+        except RuntimeError:
+            notifier.post(f"paper{i}", ts)
+    notifier.update("done", ts)
+
+    assert handler.log == [
+        ("post", None, "header"),
+        ("share", ts, "F_slide0.pdf"), ("share", ts, "F_slide1.pdf"), ("share", ts, "F_slide2.pdf"),
+        ("post", ts, "paper3"), ("share", ts, "F_slide4.pdf"),
+        ("update", ts, "done"),
+    ]
+
+
+def test_upload_retries_after_429(slack, tmp_path):
+    handler, notifier = slack
+    paths = write_slides(tmp_path, 2)
+    uploaded = [notifier.upload(path).result() for path in paths]
+    assert [u["id"] for u in uploaded] == ["F_slide0.pdf", "F_slide1.pdf"]
+    # 1回目の429の後に再試行し、ファイルの全体が届いている
+    assert handler.uploads == {f"F_slide{i}.pdf": len(b"%PDF") + 1000 * (i + 1) for i in range(2)}
+
+
+def test_falls_back_to_channel_when_thread_is_missing(slack, tmp_path):
+    handler, notifier = slack
+    path, = write_slides(tmp_path, 1)
+    notifier.post("lost thread", "missing")
+    notifier.share(notifier.upload(path).result(), "lost thread", "missing")
+    assert handler.log == [("post", None, "lost thread"), ("share", None, "F_slide0.pdf")]
@@ -0,0 +1,62 @@
+import datetime
+import json
+
+from arxiv_mirror import ArxivPaper
+from cache import text_hash
+from slide_owl import PROMPT, TEMPERATURE, Result, get_summaries, parse_batch_summary
+
+FIELDS = {"title_jp": "題", "keywords": "k", "problem": "p", "method": "m", "result": "r", "terminology": []}
+# 文字列のidや余分な空白も、モデルが返したまま残す
+BATCH_REPLY = json.dumps({"papers": [
+    {"id": "1", **FIELDS, "title_jp": "二本目"},
+    {"id": 0, **FIELDS, "title_jp": "一本目", "note": "extra"},
+]}, ensure_ascii=False, indent=2)
+
+
+class DictCache(dict):
+    def set(self, key, value):
+        self[key] = value
+
+
+class CannedSummarizer:
+    """completeに決まった応答を返すSummarizerの代わり"""
+    model = "stub"
+
+    def __init__(self, reply: str):
+        self.reply = reply
+        self.cache = DictCache()
+        self.messages = []
+
+    def complete(self, messages: list, **kwargs) -> str:
+        self.messages.append(messages)
+        return self.reply
+
+
+def make_result(i: int) -> Result:
+    day = datetime.datetime(2024, 1, 5, tzinfo=datetime.timezone.utc)
+    return Result(source="arxiv", res=ArxivPaper(
+        f"http://arxiv.org/abs/2401.0000{i}v1", f"Paper {i}", f"Abstract {i}", "A. Author", day, day))
+
+
+def test_parse_batch_summary_keeps_each_papers_raw_output():
+    summary_dicts, completions = parse_batch_summary(BATCH_REPLY, 3)
+    assert [d and d["title_jp"] for d in summary_dicts] == ["一本目", "二本目", None]
+    assert json.loads(completions[0]) == json.loads(BATCH_REPLY)["papers"][1]
+    assert completions[2] is None
+
+
+def test_get_summaries_caches_the_model_output():
+    summarizer = CannedSummarizer(BATCH_REPLY)
+    outputs = get_summaries([make_result(0), make_result(1)], summarizer)
+    assert [output["title_jp"] for output in outputs] == ["一本目", "二本目"]
+    assert len(summarizer.messages) == 1
+
+    cached = summarizer.cache[text_hash("stub", PROMPT, TEMPERATURE, "Paper 0", "Abstract 0")]
+    # 整形した項目ではなく、応答のうちこの論文の部分
+    assert json.loads(cached["completion"])["note"] == "extra"
+    assert cached["fields"]["title_jp"] == "一本目"
+
+    # 2回目はキャッシュから返し、リクエストしない
+    assert [output["title_jp"] for output in get_summaries([make_result(0), make_result(1)], summarizer)] == \
+           ["一本目", "二本目"]
+    assert len(summarizer.messages) == 1
@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import openai
+import pytest
+from openai import OpenAI
+
+from summarizer import LatencyHistogram, RateLimiter, Summarizer, parse_duration
+
+
+def make_stub_openai(responses: list, delay: float = 0.0):
+    """
+    OpenAI互換の/v1/chat/completionsのスタブ。responsesの(ステータス, ヘッダー)を順に返し、
+    使い切った後は200で最後のユーザーメッセージをそのまま返す。受けたリクエストはhandler.requestsに残る。
+    """
+
+    class StubOpenAI(BaseHTTPRequestHandler):
+        requests = []
+        lock = threading.Lock()
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with self.lock:
+                self.requests.append(body)
+                status, headers = responses.pop(0) if responses else (200, {})
+            time.sleep(delay)
+            if status == 200:
+                payload = {
+                    "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": body["messages"][-1]["content"]}}],
+                }
+            else:
+                payload = {"error": {"message": f"stub error {status}", "type": "stub", "code": None}}
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return StubOpenAI
+
+
+def make_summarizer(url: str, **kwargs) -> Summarizer:
+    return Summarizer(OpenAI(api_key="sk-test", base_url=f"{url}/v1", max_retries=0), **kwargs)
+
+
+def test_complete_retries_429_and_5xx(http_server):
+    handler = make_stub_openai([
+        (500, {}),
+        (429, {"retry-after": "0.1", "x-ratelimit-limit-requests": "120", "x-ratelimit-remaining-requests": "0",
+               "x-ratelimit-reset-requests": "200ms"}),
+        (503, {"retry-after": "0.1"}),
+    ])
+    summarizer = make_summarizer(http_server(handler), max_retries=5)
+    messages = [{"role": "system", "content": "s"}, {"role": "user", "content": "hello"}]
+    assert summarizer.complete(messages) == "hello"
+    assert len(handler.requests) == 4
+    # 429のヘッダーから補充の速さを合わせている
+    assert summarizer.limiter.rate == 2
+    assert summarizer.latency.summary().startswith("1 requests")
+    summarizer.close()
+
+
+def test_complete_gives_up_after_max_retries(http_server):
+    handler = make_stub_openai([(429, {"retry-after": "0.05"})] * 3)
+    summarizer = make_summarizer(http_server(handler), max_retries=2)
+    with pytest.raises(openai.RateLimitError):
+        summarizer.complete([{"role": "user", "content": "hello"}])
+    assert len(handler.requests) == 3
+    summarizer.close()
+
+
+def test_parallel_throughput(http_server):
+    handler = make_stub_openai([], delay=0.3)
+    summarizer = make_summarizer(http_server(handler), max_workers=4, requests_per_minute=6000)
+    start = time.monotonic()
+    futures = [summarizer.submit(summarizer.complete, [{"role": "user", "content": str(i)}]) for i in range(8)]
+    assert [future.result() for future in futures] == [str(i) for i in range(8)]
+    elapsed = time.monotonic() - start
+    summarizer.close()
+    # 1件ずつなら2.4秒かかる
+    assert elapsed < 1.6, elapsed
+    print(f"8 requests in {elapsed:.2f} s: {summarizer.latency.summary()}")
+
+
+def test_rate_limiter_waits_for_tokens_and_blocks():
+    limiter = RateLimiter(requests_per_minute=600, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.acquire()
+    # 2件はすぐに通り、残りの2件は0.1秒ずつ待つ
+    assert 0.15 < time.monotonic() - start < 0.5
+    limiter.update({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "300ms"})
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.25
+
+
+def test_parse_duration_and_histogram():
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1.5s") == 1.5
+    assert abs(parse_duration("20ms") - 0.02) < 1e-9
+    assert parse_duration("") == 0
+    histogram = LatencyHistogram()
+    for seconds in (0.2, 0.7, 3, 100):
+        histogram.add(seconds)
+    assert histogram.counts == [1, 1, 0, 1, 0, 0, 0, 0, 1]
+    assert "4 requests" in histogram.summary()
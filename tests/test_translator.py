@@ -0,0 +1,148 @@
+import json
+import shutil
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+import requests
+from selenium.common.exceptions import NoSuchElementException
+
+from slide_owl import Result, resolve_translation
+from translator import RESULT_XPATH, SeleniumTranslator, get_translated_text, make_driver
+
+# DeepLの翻訳ページの代わり。URLのフラグメントの原文を/translateで訳し、2回に分けて書き込む
+STUB_PAGE = """<!DOCTYPE html>
+<html><body>
+<div id="textareasContainer"><div></div><div></div>
+  <div><section><div><d-textarea><div id="target"></div></d-textarea></div></section></div>
+</div>
+<script>
+async function translate() {
+  const [from, to, ...rest] = location.hash.slice(1).split("/");
+  const response = await fetch("/translate?text=" + rest.join("/"));
+  const text = (await response.json()).text;
+  const target = document.getElementById("target");
+  target.textContent = text.slice(0, text.length / 2);
+  setTimeout(() => { target.textContent = text; }, 200);
+}
+window.addEventListener("hashchange", translate);
+translate();
+</script>
+</body></html>
+"""
+
+
+def fake_translate(text: str) -> str:
+    return "訳:" + text
+
+
+class StubDeepL(BaseHTTPRequestHandler):
+    delay = 0.3
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/translate":
+            time.sleep(self.delay)
+            text = urllib.parse.parse_qs(url.query)["text"][0]
+            body = json.dumps({"text": fake_translate(text)}).encode()
+            content_type = "application/json"
+        else:
+            body = STUB_PAGE.encode()
+            content_type = "text/html; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubPageDriver:
+    """
+    ブラウザの無い環境でSTUB_PAGEと同じ動きをするWebDriverの代わり。
+    ページが同じでフラグメントだけ変わった場合は、新しい訳文が届くまで前の訳文が残る。
+    """
+
+    class Element:
+        def __init__(self, driver):
+            self.driver = driver
+
+        def get_attribute(self, name):
+            assert name == "textContent"
+            return self.driver.text
+
+    def __init__(self):
+        self.page = None
+        self.text = None
+
+    def implicitly_wait(self, seconds):
+        pass
+
+    def set_page_load_timeout(self, seconds):
+        pass
+
+    def get(self, url: str):
+        page, _, fragment = url.partition("#")
+        if page != self.page:
+            self.page = page
+            self.text = ""
+        _, _, quoted_text = fragment.split("/", 2)
+        origin = "/".join(page.split("/")[:3])
+        threading.Thread(target=self._translate, args=(origin, quoted_text), daemon=True).start()
+
+    def _translate(self, origin: str, quoted_text: str):
+        text = requests.get(f"{origin}/translate?text={quoted_text}").json()["text"]
+        self.text = text[:len(text) // 2]
+        time.sleep(0.2)
+        self.text = text
+
+    def find_element(self, by, value):
+        assert value == RESULT_XPATH
+        if self.text is None:
+            raise NoSuchElementException()
+        return self.Element(self)
+
+    def quit(self):
+        pass
+
+
+TEXTS = [f"Abstract {i}: the plasma is confined by a magnetic field." for i in range(8)]
+
+
+def test_pool_keeps_order_and_abst_jp(http_server):
+    url = http_server(StubDeepL)
+    translator = SeleniumTranslator(n_workers=3, driver_factory=StubPageDriver, base_url=f"{url}/translator", timeout=10)
+    start = time.monotonic()
+    results = [Result(abst_jp=translator.submit("en", "ja", text)) for text in TEXTS]
+    for result in results:
+        resolve_translation(result, translator)
+    elapsed = time.monotonic() - start
+    n_drivers = len(translator.drivers)
+    translator.close()
+
+    assert [result.abst_jp for result in results] == [fake_translate(text) for text in TEXTS]
+    assert n_drivers == 3
+    print(f"Translated {len(TEXTS)} abstracts with {n_drivers} drivers in {elapsed:.1f} s.")
+
+
+def test_reused_driver_does_not_return_previous_translation(http_server, monkeypatch):
+    # 訳文が届くまでの間、前の訳文がstable_forより長く残る
+    monkeypatch.setattr(StubDeepL, "delay", 0.8)
+    url = http_server(StubDeepL)
+    driver = StubPageDriver()
+    first = get_translated_text("en", "ja", TEXTS[0], driver, base_url=f"{url}/translator", timeout=10)
+    second = get_translated_text("en", "ja", TEXTS[1], driver, base_url=f"{url}/translator", timeout=10)
+    assert (first, second) == (fake_translate(TEXTS[0]), fake_translate(TEXTS[1]))
+
+
+@pytest.mark.skipif(shutil.which("firefox") is None, reason="Firefox is not installed.")
+def test_pool_with_firefox(http_server):
+    url = http_server(StubDeepL)
+    translator = SeleniumTranslator(n_workers=2, driver_factory=make_driver, base_url=f"{url}/translator", timeout=20)
+    futures = [translator.submit("en", "ja", text) for text in TEXTS[:4]]
+    translator.close()
+    assert [future.result() for future in futures] == [fake_translate(text) for text in TEXTS[:4]]